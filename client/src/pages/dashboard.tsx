@@ -17,9 +17,18 @@ const Dashboard = () => {
     const [passportUrl, setPassportUrl] = useState<string>('');
 
     useEffect(() => {
+        if (!user) return;
+
+        // New enrollments store the digest of the crop in the image store
+        if (/^[0-9a-f]{64}$/.test(user.passport ?? '')) {
+            setPassportUrl(`http://localhost:8000/images/${user.passport}?size=256&format=webp`);
+            return;
+        }
+
+        // Students enrolled before the image store have it under src/assets
         const images = import.meta.glob('/src/assets/user/**/passport.jpg');
 
-        const filePath = `/src/assets/user/${user?.student_id.toUpperCase()}/passport.jpg`;
+        const filePath = `/src/assets/user/${user.student_id.toUpperCase()}/passport.jpg`;
 
         if (images[filePath]) {
             images[filePath]().then((module: any) => {
@@ -28,7 +37,7 @@ const Dashboard = () => {
         } else {
             console.warn('Passport image not found');
         }
-    }, [user?.student_id]);
+    }, [user?.student_id, user?.passport]);
 
     const items: MenuProps['items'] = navMap();
 
@@ -21,7 +21,10 @@ if config.config_file_name is not None:
 from models.user import User
 from models.session import Session
 
-from config import Base
+from config import Base, SQLALCHEMY_DATABASE_URL
+
+# Migrate the same database the app uses (DATABASE_URL)
+config.set_main_option("sqlalchemy.url", SQLALCHEMY_DATABASE_URL.replace("%", "%%"))
 
 # target_metadata = mymodel.Base.metadata
 target_metadata =  Base.metadata
@@ -0,0 +1,30 @@
+"""Session indexes
+
+Revision ID: 9a19e641b511
+Revises: d166f42a0215
+Create Date: 2026-10-18 13:40:02.518774
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '9a19e641b511'
+down_revision: Union[str, None] = 'd166f42a0215'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_index('ix_sessions_token_expiration', 'sessions', ['session_token', 'expiration'], unique=False)
+    op.create_index('ix_sessions_user_id', 'sessions', ['user_id'], unique=False)
+    op.create_index('ix_sessions_expiration', 'sessions', ['expiration'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index('ix_sessions_expiration', table_name='sessions')
+    op.drop_index('ix_sessions_user_id', table_name='sessions')
+    op.drop_index('ix_sessions_token_expiration', table_name='sessions')
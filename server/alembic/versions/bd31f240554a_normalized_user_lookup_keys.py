@@ -0,0 +1,64 @@
+"""Normalized user lookup keys
+
+Revision ID: bd31f240554a
+Revises: 9a19e641b511
+Create Date: 2026-10-18 14:21:37.940261
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'bd31f240554a'
+down_revision: Union[str, None] = '9a19e641b511'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+users = sa.table(
+    'users',
+    sa.column('id', sa.Integer),
+    sa.column('student_id', sa.String),
+    sa.column('matriculation_number', sa.String),
+    sa.column('student_id_key', sa.String),
+    sa.column('matriculation_number_key', sa.String),
+)
+
+
+def normalize_key(value):
+    # Same as models.user.normalize_key. Done in Python rather than SQL lower(),
+    # which only folds ASCII on SQLite.
+    return value.lower() if value is not None else None
+
+
+def upgrade() -> None:
+    op.add_column('users', sa.Column('student_id_key', sa.String(), nullable=True))
+    op.add_column('users', sa.Column('matriculation_number_key', sa.String(), nullable=True))
+
+    connection = op.get_bind()
+    rows = connection.execute(
+        sa.select(users.c.id, users.c.student_id, users.c.matriculation_number)
+    ).fetchall()
+    for user_id, student_id, matriculation_number in rows:
+        connection.execute(
+            users.update()
+            .where(users.c.id == user_id)
+            .values(
+                student_id_key=normalize_key(student_id),
+                matriculation_number_key=normalize_key(matriculation_number),
+            )
+        )
+
+    op.create_index(op.f('ix_users_student_id_key'), 'users', ['student_id_key'], unique=True)
+    op.create_index(op.f('ix_users_matriculation_number_key'), 'users', ['matriculation_number_key'], unique=True)
+
+
+def downgrade() -> None:
+    op.drop_index(op.f('ix_users_matriculation_number_key'), table_name='users')
+    op.drop_index(op.f('ix_users_student_id_key'), table_name='users')
+    with op.batch_alter_table('users') as batch_op:
+        batch_op.drop_column('matriculation_number_key')
+        batch_op.drop_column('student_id_key')
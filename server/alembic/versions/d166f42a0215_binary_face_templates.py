@@ -0,0 +1,88 @@
+"""Binary face templates
+
+Revision ID: d166f42a0215
+Revises: bf028f2d367c
+Create Date: 2026-10-18 10:12:41.305118
+
+"""
+import json
+import struct
+from typing import Sequence, Union
+
+from alembic import op
+import numpy as np
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'd166f42a0215'
+down_revision: Union[str, None] = 'bf028f2d367c'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+# Frozen copy of the version 1 layout from templates.py, so this migration
+# keeps working if the application format moves on
+HEADER = struct.Struct("<4sBBHI4x")
+
+users = sa.table(
+    'users',
+    sa.column('id', sa.Integer),
+    sa.column('face_encodings', sa.JSON),
+    sa.column('face_templates', sa.LargeBinary),
+)
+
+
+def pack(encodings):
+    matrix = np.asarray(encodings, dtype='<f4').reshape(-1, 128)
+    return HEADER.pack(b'FTPL', 1, 1, 128, len(matrix)) + matrix.tobytes()
+
+
+def unpack(blob):
+    _, _, dtype_code, dimensions, count = HEADER.unpack_from(blob)
+    dtype = '<f4' if dtype_code == 1 else '<f2'
+    return np.frombuffer(
+        blob, dtype=dtype, count=count * dimensions, offset=HEADER.size
+    ).reshape(count, dimensions)
+
+
+def upgrade() -> None:
+    op.add_column('users', sa.Column('face_templates', sa.LargeBinary(), nullable=True))
+
+    connection = op.get_bind()
+    rows = connection.execute(
+        sa.select(users.c.id, users.c.face_encodings).where(
+            users.c.face_encodings.isnot(None)
+        )
+    ).fetchall()
+    for user_id, encodings in rows:
+        if isinstance(encodings, str):
+            encodings = json.loads(encodings)
+        connection.execute(
+            users.update()
+            .where(users.c.id == user_id)
+            .values(face_templates=pack(encodings or []))
+        )
+
+    with op.batch_alter_table('users') as batch_op:
+        batch_op.drop_column('face_encodings')
+
+
+def downgrade() -> None:
+    op.add_column('users', sa.Column('face_encodings', sa.JSON(), nullable=True))
+
+    connection = op.get_bind()
+    rows = connection.execute(
+        sa.select(users.c.id, users.c.face_templates).where(
+            users.c.face_templates.isnot(None)
+        )
+    ).fetchall()
+    for user_id, blob in rows:
+        connection.execute(
+            users.update()
+            .where(users.c.id == user_id)
+            .values(face_encodings=unpack(blob).astype(float).tolist())
+        )
+
+    with op.batch_alter_table('users') as batch_op:
+        batch_op.drop_column('face_templates')
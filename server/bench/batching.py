@@ -0,0 +1,117 @@
+"""
+Throughput and tail latency of face analysis with and without micro-batching.
+
+Starts a face pool and runs --requests analyses of the image at each
+concurrency level, first with every image encoded in the job that detected
+it (window 0) and then through EncodeBatcher at each --windows setting.
+Prints analyses per second, latency percentiles and the mean batch size as
+JSON.
+
+Run from the server directory:
+
+    python -m bench.batching path/to/face.jpg --workers 2 --concurrency 1 8 32 \
+        --windows 0 5 10 --max-batch 16
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import sys
+import time
+
+import face_worker
+import metrics
+from bench.report import summarize
+from face_batcher import EncodeBatcher
+from face_pool import FacePool
+
+
+async def drive(analyze, image_bytes, requests, concurrency):
+    latencies = []
+    faces = 0
+    remaining = iter(range(requests))
+
+    async def worker():
+        nonlocal faces
+        for _ in remaining:
+            start = time.perf_counter()
+            analysis = await analyze(image_bytes)
+            latencies.append((time.perf_counter() - start) * 1000)
+            faces += len(analysis.encodings)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return summarize(latencies, time.perf_counter() - start), faces
+
+
+def batch_sizes():
+    # (sum, count) of the encode_batch_size histogram so far
+    samples = {
+        sample.name: sample.value
+        for metric in metrics.encode_batch_size.collect()
+        for sample in metric.samples
+    }
+    return samples["encode_batch_size_sum"], samples["encode_batch_size_count"]
+
+
+async def run(image_bytes, workers, levels, windows, max_batch, requests):
+    # Room for every concurrent request, the bench measures queueing, not 503s
+    pool = FacePool(workers, queue_size=max(levels) * 2, retry_after=1)
+    pool.start()
+    try:
+        await pool.warm_up()
+        report = []
+        for window in windows:
+            if window:
+                batcher = EncodeBatcher(pool, window / 1000, max_batch)
+                analyze = batcher.analyze
+            else:
+                analyze = lambda image: pool.run(face_worker.analyze_image, image)
+            for concurrency in levels:
+                before = batch_sizes()
+                summary, faces = await drive(analyze, image_bytes, requests, concurrency)
+                after = batch_sizes()
+                batches = after[1] - before[1]
+                report.append(
+                    {
+                        "window_ms": window,
+                        "max_batch": max_batch if window else None,
+                        "concurrency": concurrency,
+                        **summary,
+                        "faces": faces,
+                        "mean_batch": (after[0] - before[0]) / batches if batches else None,
+                    }
+                )
+        return report
+    finally:
+        pool.shutdown()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("image", help="Photo with a face")
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--concurrency", nargs="+", type=int, default=[1, 8, 32])
+    parser.add_argument("--windows", nargs="+", type=float, default=[0, 5, 10])
+    parser.add_argument("--max-batch", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=64)
+    args = parser.parse_args(argv)
+
+    image_bytes = open(args.image, "rb").read()
+    with contextlib.redirect_stdout(sys.stderr):
+        results = asyncio.run(
+            run(
+                image_bytes,
+                args.workers,
+                args.concurrency,
+                args.windows,
+                args.max_batch,
+                args.requests,
+            )
+        )
+    json.dump({"workers": args.workers, "results": results}, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == "__main__":
+    main()
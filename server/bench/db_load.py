@@ -0,0 +1,130 @@
+"""
+Login database load test.
+
+Runs the database side of a login (user lookup, session insert with the
+per-user cap, session verification) from many threads against a temporary
+SQLite database, once with the default rollback journal and once with the
+WAL pragmas from config.create_db_engine, and prints logins per second and
+latency percentiles for each concurrency level as JSON.
+
+Run from the server directory:
+
+    python -m bench.db_load --users 2000 --logins 2000 --concurrency 1 4 8 16
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from sqlalchemy.orm import sessionmaker
+
+from config import Base, create_db_engine
+from models.user import User, normalize_key
+from models.session import Session  # noqa: F401, registers the table
+import session as sessions
+
+
+def populate(SessionLocal, users):
+    db = SessionLocal()
+    db.add_all(
+        User(
+            student_id=f"STU{index:06d}",
+            matriculation_number=f"MAT/{index:06d}",
+            email=f"student{index}@example.com",
+            firstname="Bench",
+            lastname=f"User{index}",
+        )
+        for index in range(users)
+    )
+    db.commit()
+    db.close()
+
+
+def login(SessionLocal, index):
+    start = time.perf_counter()
+    db = SessionLocal()
+    try:
+        user = (
+            db.query(User)
+            .filter(
+                User.student_id_key == normalize_key(f"stu{index:06d}"),
+                User.matriculation_number_key == normalize_key(f"mat/{index:06d}"),
+            )
+            .first()
+        )
+        token = sessions.create_user_session(user, db)
+        sessions.session_cache.invalidate(token)  # measure the database path
+        assert sessions.resolve_session(token, db) is not None
+    finally:
+        db.close()
+    return (time.perf_counter() - start) * 1000
+
+
+def run(users, logins, levels, wal):
+    directory = tempfile.mkdtemp()
+    engine = create_db_engine(f"sqlite:///{os.path.join(directory, 'bench.db')}", sqlite_wal=wal)
+    Base.metadata.create_all(engine)
+    SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    populate(SessionLocal, users)
+
+    results = []
+    for concurrency in levels:
+        errors = []
+        lock = threading.Lock()
+
+        def attempt(index):
+            try:
+                return login(SessionLocal, index % users)
+            except Exception as e:
+                with lock:
+                    errors.append(type(e).__name__)
+                return None
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            latencies = [
+                latency
+                for latency in executor.map(attempt, range(logins))
+                if latency is not None
+            ]
+        elapsed = time.perf_counter() - start
+        results.append(
+            {
+                "concurrency": concurrency,
+                "logins_per_second": len(latencies) / elapsed,
+                "p50_ms": float(np.percentile(latencies, 50)) if latencies else None,
+                "p95_ms": float(np.percentile(latencies, 95)) if latencies else None,
+                "p99_ms": float(np.percentile(latencies, 99)) if latencies else None,
+                "errors": len(errors),
+            }
+        )
+    engine.dispose()
+    shutil.rmtree(directory, ignore_errors=True)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--logins", type=int, default=2000)
+    parser.add_argument("--concurrency", nargs="+", type=int, default=[1, 4, 8, 16])
+    args = parser.parse_args(argv)
+
+    report = {
+        "users": args.users,
+        "logins": args.logins,
+        "rollback_journal": run(args.users, args.logins, args.concurrency, wal=False),
+        "wal": run(args.users, args.logins, args.concurrency, wal=True),
+    }
+    json.dump(report, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,270 @@
+"""
+Load test of the auth endpoints through an in-process ASGI client.
+
+Creates a temporary SQLite database holding a synthetic population of users
+with random 128-d templates, starts the app with its lifespan (face workers,
+warm-up, index) and drives /face-auth, /face-register, /user-data and
+/validate-token through httpx at each concurrency level. Prints requests per
+second, latency percentiles and status code counts per endpoint and level
+as JSON. Nothing leaves the process and everything runs on the CPU.
+
+The templates of the users that log in are jittered copies of the encoding
+of --image, so /face-auth goes all the way to a successful match; when the
+image has no face every login ends after detection with a 400. Each
+registration sends five variants (mirrored, rotated, cropped) of the image.
+
+Every login sends the same image, so the encoding cache is off and
+face_auth measures the whole pipeline. face_auth_cached runs the same logins
+with the cache on, i.e. a client resubmitting a frame it already sent.
+
+Run from the server directory:
+
+    python -m bench.endpoints --image path/to/face.jpg --users 10000 \
+        --requests 200 --concurrency 1 4 16
+"""
+import argparse
+import asyncio
+import base64
+import contextlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from collections import Counter
+from io import BytesIO
+
+import numpy as np
+from PIL import Image, ImageEnhance, ImageOps
+
+from bench.report import summarize
+
+ENDPOINTS = ("face_auth", "face_auth_cached", "face_register", "user_data", "validate_token")
+
+
+def jpeg(image: Image.Image) -> bytes:
+    buffer = BytesIO()
+    image.save(buffer, format="JPEG", quality=90)
+    return buffer.getvalue()
+
+
+def register_variants(image_bytes: bytes):
+    # Five frames far enough apart to pass the enrollment duplicate check
+    image = Image.open(BytesIO(image_bytes)).convert("RGB")
+    width, height = image.size
+    mirrored = ImageOps.mirror(image)
+    return [
+        jpeg(image),
+        jpeg(mirrored),
+        jpeg(image.rotate(8, resample=Image.BILINEAR)),
+        jpeg(mirrored.rotate(-8, resample=Image.BILINEAR)),
+        jpeg(
+            ImageEnhance.Contrast(
+                image.crop((width // 10, height // 10, width, height))
+            ).enhance(0.7)
+        ),
+    ]
+
+
+def populate(users, login_users, encoding, rng):
+    from config import Base, SessionLocal, TEMPLATE_DTYPE, engine
+    from models.user import User
+    from session import create_user_session
+    from templates import pack_templates
+
+    Base.metadata.create_all(engine)
+    db = SessionLocal()
+    try:
+        for start in range(0, users, 1000):
+            batch = []
+            for index in range(start, min(start + 1000, users)):
+                if index < login_users and encoding is not None:
+                    templates = encoding + rng.normal(scale=0.01, size=(5, 128))
+                else:
+                    # Roughly the spread of real encodings
+                    templates = rng.normal(scale=0.09, size=(5, 128))
+                batch.append(
+                    User(
+                        student_id=f"STU{index:06d}",
+                        matriculation_number=f"MAT/{index:06d}",
+                        email=f"student{index}@example.com",
+                        firstname="Bench",
+                        lastname=f"User{index}",
+                        face_templates=pack_templates(templates, dtype=TEMPLATE_DTYPE),
+                    )
+                )
+            db.add_all(batch)
+            db.commit()
+        # Session cookies for /user-data and /validate-token
+        return [
+            create_user_session(user, db)
+            for user in db.query(User).order_by(User.id).limit(login_users)
+        ]
+    finally:
+        db.close()
+
+
+async def drive(send, requests, concurrency):
+    latencies = []
+    statuses = Counter()
+    indexes = iter(range(requests))
+
+    async def worker():
+        # The coroutines share one iterator, every index is sent once
+        for index in indexes:
+            start = time.perf_counter()
+            response = await send(index)
+            latencies.append((time.perf_counter() - start) * 1000)
+            statuses[str(response.status_code)] += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return {
+        "concurrency": concurrency,
+        **summarize(latencies, time.perf_counter() - start),
+        "status": dict(statuses),
+    }
+
+
+async def run(args, image_bytes, tokens, login_users):
+    import httpx
+
+    import face_worker
+    import main
+    from encoding_cache import EncodingCache
+    from face_pool import face_pool
+
+    app = main.app
+
+    image = base64.b64encode(image_bytes).decode()
+    variants = [base64.b64encode(data).decode() for data in register_variants(image_bytes)]
+    registrations = iter(range(sys.maxsize))
+
+    def registration(index):
+        number = next(registrations)
+        return {
+            "student_id": f"REG{number:06d}",
+            "matriculation_number": f"REG/{number:06d}",
+            "firstname": "Bench",
+            "middlename": "",
+            "lastname": "Registrant",
+            "date_of_birth": "2000-01-01",
+            "email": f"registrant{number}@example.com",
+            "phone_number": "0000000000",
+            "faculty": "Bench",
+            "department": "Bench",
+            "level": "100",
+            "academic_session": "2023/2024",
+            "face_encodings": variants,
+        }
+
+    def credentials(index):
+        index %= login_users
+        return {"student_id": f"STU{index:06d}", "matriculation_number": f"MAT/{index:06d}"}
+
+    def cookie(index):
+        return {"Cookie": f"session_token={tokens[index % len(tokens)]}"}
+
+    async with app.router.lifespan_context(app):
+        while not face_pool.ready:
+            await asyncio.sleep(0.1)
+
+        # Server errors count as 500s instead of aborting the run
+        transport = httpx.ASGITransport(app=app, raise_app_exceptions=False)
+        async with httpx.AsyncClient(
+            transport=transport, base_url="http://bench", timeout=None
+        ) as client:
+            senders = {
+                "face_auth": lambda index: client.post(
+                    "/face-auth", json={**credentials(index), "face_encoding": image}
+                ),
+                "face_auth_cached": lambda index: client.post(
+                    "/face-auth", json={**credentials(index), "face_encoding": image}
+                ),
+                "face_register": lambda index: client.post(
+                    "/face-register", json=registration(index)
+                ),
+                "user_data": lambda index: client.post("/user-data", headers=cookie(index)),
+                "validate_token": lambda index: client.post(
+                    "/validate-token", headers=cookie(index)
+                ),
+            }
+            report = {}
+            uncached = main.encoding_cache
+            for endpoint in args.endpoints:
+                if endpoint == "face_auth_cached":
+                    main.encoding_cache = EncodingCache(
+                        face_worker.pipeline.model_version, max_entries=16, ttl=3600
+                    )
+                requests = args.requests if endpoint.startswith("face_") else args.requests * 10
+                report[endpoint] = [
+                    await drive(senders[endpoint], requests, concurrency)
+                    for concurrency in args.concurrency
+                ]
+                main.encoding_cache = uncached
+            return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--image", help="Photo with a face (default: synthetic image)")
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--login-users", type=int, default=100)
+    parser.add_argument(
+        "--requests",
+        type=int,
+        default=100,
+        help="Requests per level for the face endpoints, ten times that for the others",
+    )
+    parser.add_argument("--concurrency", nargs="+", type=int, default=[1, 4, 16])
+    parser.add_argument("--endpoints", nargs="+", choices=ENDPOINTS, default=list(ENDPOINTS))
+    parser.add_argument("--workers", type=int, help="FACE_WORKERS for the run")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    directory = tempfile.mkdtemp()
+    # config reads the environment on import, so set it before anything loads it
+    os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(directory, 'bench.db')}"
+    os.environ.pop("ASYNC_DATABASE_URL", None)
+    if args.workers:
+        os.environ["FACE_WORKERS"] = str(args.workers)
+    # Passports of the bench registrations stay in the temp dir
+    os.environ["IMAGE_STORE_DIR"] = os.path.join(directory, "images")
+    os.environ["TEMPLATE_SNAPSHOT_DIR"] = os.path.join(directory, "snapshots")
+    # Every bench request comes from one client, the limits would throttle it
+    os.environ["RATE_LIMIT_BACKEND"] = "off"
+    # Every login sends the same image, with the cache on face_auth would only
+    # measure cache hits (face_auth_cached turns it on for its own run)
+    os.environ["ENCODING_CACHE_SIZE"] = "0"
+
+    try:
+        from face_pipeline import synthetic_image
+
+        image_bytes = open(args.image, "rb").read() if args.image else synthetic_image()
+        rng = np.random.default_rng(args.seed)
+        # Server log lines go to stderr so stdout stays valid JSON
+        with contextlib.redirect_stdout(sys.stderr):
+            import face_worker
+
+            encodings = face_worker.analyze_image(image_bytes).encodings
+            login_users = min(args.login_users, args.users)
+            tokens = populate(
+                args.users, login_users, encodings[0] if encodings else None, rng
+            )
+            results = asyncio.run(run(args, image_bytes, tokens, login_users))
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    report = {
+        "users": args.users,
+        "login_users": login_users,
+        "image_has_face": bool(encodings),
+        "endpoints": results,
+    }
+    json.dump(report, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == "__main__":
+    main()
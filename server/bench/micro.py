@@ -0,0 +1,79 @@
+"""
+Microbenchmarks of the per-request helpers, outside the server.
+
+Times verify_face_encoding (one probe against a user's templates),
+safe_b64decode (a data URL of the image, as the client sends it) and
+crop_image_with_padding (detection plus crop, needs dlib) and prints calls
+per second and latency percentiles as JSON.
+
+Run from the server directory:
+
+    python -m bench.micro --image path/to/face.jpg --iterations 200
+"""
+import argparse
+import base64
+import json
+import sys
+import time
+
+import numpy as np
+
+from bench.report import summarize
+from face_pipeline import synthetic_image
+from matcher import verify_face_encoding
+from uploads import safe_b64decode
+
+
+def measure(fn, iterations, warmup=3):
+    for _ in range(warmup):
+        fn()
+    latencies = []
+    start = time.perf_counter()
+    for _ in range(iterations):
+        call_start = time.perf_counter()
+        fn()
+        latencies.append((time.perf_counter() - call_start) * 1000)
+    return summarize(latencies, time.perf_counter() - start)
+
+
+def run(image_bytes, iterations, templates, seed):
+    rng = np.random.default_rng(seed)
+    user_encodings = rng.normal(size=(templates, 128)).astype(np.float32)
+    probe = user_encodings[0] + rng.normal(scale=0.01, size=128).astype(np.float32)
+    data_url = "data:image/jpeg;base64," + base64.b64encode(image_bytes).decode()
+
+    report = {
+        "image_bytes": len(image_bytes),
+        "templates": templates,
+        "verify_face_encoding": measure(
+            lambda: verify_face_encoding(user_encodings, probe), iterations
+        ),
+        "safe_b64decode": measure(lambda: safe_b64decode(data_url), iterations),
+    }
+    try:
+        from face_worker import crop_image_with_padding
+
+        report["crop_image_with_padding"] = measure(
+            lambda: crop_image_with_padding(image_bytes), iterations
+        )
+    except (ImportError, ValueError) as e:
+        # No dlib here, or no face in the image
+        report["crop_image_with_padding"] = {"skipped": str(e)}
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--image", help="Photo with a face (default: synthetic image)")
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument("--templates", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    image_bytes = open(args.image, "rb").read() if args.image else synthetic_image()
+    json.dump(run(image_bytes, args.iterations, args.templates, args.seed), sys.stdout, indent=2)
+    print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+"""
+Accuracy and latency of the face pipeline at different detection sizes.
+
+Every image is first analyzed at full resolution (no draft decode, no
+downscale) as the reference. Each configured FACE_DETECT_MAX_SIDE is then
+compared against it: per stage latency, how many reference faces were still
+found, and how far their encodings moved from the reference encodings
+(well under the 0.4 match tolerance is what we want).
+
+Run from the server directory:
+
+    python -m bench.preprocess path/to/photos --sizes 320 480 640 800 --repeat 3
+"""
+import argparse
+import json
+import sys
+from pathlib import Path
+
+import numpy as np
+
+from face_pipeline import FacePipeline
+from matcher import face_distances
+
+
+IMAGE_SUFFIXES = {".jpg", ".jpeg", ".png", ".webp"}
+
+
+def percentile(values, q):
+    return float(np.percentile(values, q)) if values else None
+
+
+def load_images(paths):
+    images = []
+    for path in map(Path, paths):
+        files = sorted(path.rglob("*")) if path.is_dir() else [path]
+        images.extend(
+            (str(file), file.read_bytes())
+            for file in files
+            if file.suffix.lower() in IMAGE_SUFFIXES
+        )
+    return images
+
+
+def run(images, sizes, encode_max_side, repeat):
+    reference = FacePipeline(detect_max_side=0, encode_max_side=0)
+    baseline = {name: reference.analyze(data) for name, data in images}
+
+    report = {"images": len(images), "encode_max_side": encode_max_side, "sizes": []}
+    for size in [0] + sizes:
+        pipeline = (
+            reference
+            if size == 0
+            else FacePipeline(detect_max_side=size, encode_max_side=encode_max_side)
+        )
+        timings = {}
+        found = expected = 0
+        drift = []
+        for _ in range(repeat):
+            for name, data in images:
+                analysis = pipeline.analyze(data)
+                for stage, duration in analysis.timings.items():
+                    timings.setdefault(stage, []).append(duration)
+                timings.setdefault("total", []).append(sum(analysis.timings.values()))
+
+                expected_encodings = baseline[name].encodings
+                expected += len(expected_encodings)
+                if expected_encodings and analysis.encodings:
+                    distances = face_distances(
+                        np.array(expected_encodings, dtype=np.float32),
+                        np.array(analysis.encodings, dtype=np.float32),
+                    )
+                    # Pair each reference face with its closest face at this size
+                    nearest = distances.min(axis=1)
+                    found += int(np.count_nonzero(nearest <= 0.4))
+                    drift.extend(nearest.tolist())
+
+        report["sizes"].append(
+            {
+                "detect_max_side": size or "full",
+                "latency_ms": {
+                    stage: {
+                        "p50": percentile(values, 50),
+                        "p95": percentile(values, 95),
+                        "p99": percentile(values, 99),
+                    }
+                    for stage, values in timings.items()
+                },
+                "face_recall": found / expected if expected else None,
+                "encoding_drift": {
+                    "mean": float(np.mean(drift)) if drift else None,
+                    "max": float(np.max(drift)) if drift else None,
+                },
+            }
+        )
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("paths", nargs="+", help="Image files or directories")
+    parser.add_argument("--sizes", nargs="+", type=int, default=[320, 480, 640, 800, 1024])
+    parser.add_argument("--encode-max-side", type=int, default=1600)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args(argv)
+
+    images = load_images(args.paths)
+    if not images:
+        parser.error("no images found")
+    json.dump(run(images, args.sizes, args.encode_max_side, args.repeat), sys.stdout, indent=2)
+    print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,15 @@
+import numpy as np
+
+
+def summarize(latencies, elapsed):
+    # Latencies in milliseconds, elapsed wall time in seconds
+    if not latencies:
+        return {"count": 0, "per_second": 0.0, "p50_ms": None, "p95_ms": None, "p99_ms": None}
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+    return {
+        "count": len(latencies),
+        "per_second": len(latencies) / elapsed if elapsed else None,
+        "p50_ms": float(p50),
+        "p95_ms": float(p95),
+        "p99_ms": float(p99),
+    }
@@ -0,0 +1,345 @@
+"""
+Bulk enrollment of a whole intake from photos on disk.
+
+Each student goes through the same steps as /face-register: every image is
+analyzed by the face pipeline (the first one also yields the passport crop),
+the encodings must pass check_enrollment, and the user is stored with packed
+templates and the passport in the image store. Analysis is spread over a
+process pool with one worker per core; users are written in chunked
+transactions.
+
+Input is either a CSV manifest with the RegisterForm columns plus an
+``images`` column (paths separated by ``;``, relative to the manifest) or a
+directory with one subdirectory per student, named after the student_id,
+holding the images and a ``student.json`` with the remaining fields.
+
+Progress is checkpointed after every committed chunk, so an interrupted
+import picks up where it stopped when run again with the same checkpoint.
+Students already in the database are skipped either way. Rejected students
+are recorded in the checkpoint too; start a fresh checkpoint to retry them
+with new photos. Enrolled users are appended to the template snapshot's
+delta log, so running servers pick them up for /face-identify on their next
+refresh.
+
+Run from the server directory:
+
+    python -m bulk_enroll intake.csv --chunk-size 200 --rejected rejected.csv
+"""
+import argparse
+import csv
+import json
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+from PIL import UnidentifiedImageError
+from pydantic import ValidationError
+from sqlalchemy.exc import IntegrityError
+
+import face_worker
+from config import (
+    FACE_MAX_BRIGHTNESS,
+    FACE_MAX_CLIPPED,
+    FACE_MIN_BRIGHTNESS,
+    FACE_MIN_IMAGE_SIDE,
+    FACE_MIN_SHARPNESS,
+    FACE_QUALITY_GATE,
+    IMAGE_STORE_DIR,
+    PASSPORT_THUMBNAIL_SIZES,
+    REGISTER_CONSISTENCY_DISTANCE,
+    REGISTER_DUPLICATE_DISTANCE,
+    SessionLocal,
+    TEMPLATE_DTYPE,
+    TEMPLATE_SNAPSHOT_DIR,
+)
+from image_store import ImageStore
+from matcher import check_enrollment
+from models.user import User, normalize_key
+from quality import ImageRejected, QualityGate
+from schemas import RegisterForm
+from template_snapshot import TemplateStore
+from templates import pack_templates
+
+IMAGE_SUFFIXES = {".jpg", ".jpeg", ".png", ".webp"}
+IMAGES_PER_STUDENT = 5
+
+quality_gate = QualityGate(
+    min_side=FACE_MIN_IMAGE_SIDE,
+    min_brightness=FACE_MIN_BRIGHTNESS,
+    max_brightness=FACE_MAX_BRIGHTNESS,
+    max_clipped=FACE_MAX_CLIPPED,
+    min_sharpness=FACE_MIN_SHARPNESS,
+)
+
+
+def read_manifest(source):
+    # [(fields, image paths)] from a CSV manifest or a directory of students
+    if os.path.isdir(source):
+        students = []
+        for name in sorted(os.listdir(source)):
+            directory = os.path.join(source, name)
+            if not os.path.isdir(directory):
+                continue
+            fields = {}
+            info = os.path.join(directory, "student.json")
+            if os.path.exists(info):
+                with open(info) as info_file:
+                    fields = json.load(info_file)
+            fields["student_id"] = name
+            images = [
+                os.path.join(directory, file)
+                for file in sorted(os.listdir(directory))
+                if os.path.splitext(file)[1].lower() in IMAGE_SUFFIXES
+            ]
+            students.append((fields, images))
+        return students
+
+    base = os.path.dirname(os.path.abspath(source))
+    with open(source, newline="") as manifest:
+        return [
+            (
+                {key: value for key, value in row.items() if key != "images"},
+                [
+                    os.path.join(base, path.strip())
+                    for path in (row.get("images") or "").split(";")
+                    if path.strip()
+                ],
+            )
+            for row in csv.DictReader(manifest)
+        ]
+
+
+def analyze_student(paths):
+    # Runs in a pool worker, images are read there so only results come back
+    results = []
+    for index, path in enumerate(paths):
+        try:
+            with open(path, "rb") as image_file:
+                image_bytes = image_file.read()
+            if FACE_QUALITY_GATE:
+                quality_gate.check(image_bytes)
+            analysis = face_worker.pipeline.analyze(
+                image_bytes, passport_padding=0.5 if index == 0 else None
+            )
+        except (OSError, UnidentifiedImageError) as e:
+            results.append((None, f"Cannot read image: {e}"))
+            continue
+        except ImageRejected as e:
+            results.append((None, f"{e.reason}: {e.message}"))
+            continue
+        results.append((analysis, None))
+    return results
+
+
+class Checkpoint:
+    def __init__(self, path):
+        self.path = path
+        self.done = set()
+        self.rejected = []
+        if path and os.path.exists(path):
+            with open(path) as checkpoint_file:
+                state = json.load(checkpoint_file)
+            self.done = set(state["done"])
+            self.rejected = state["rejected"]
+
+    def reject(self, student_id, reason, image=""):
+        self.rejected.append({"student_id": student_id, "image": image, "reason": reason})
+
+    def save(self):
+        if not self.path:
+            return
+        # Write then rename so a crash never leaves a truncated checkpoint
+        temporary_path = f"{self.path}.tmp"
+        with open(temporary_path, "w") as checkpoint_file:
+            json.dump({"done": sorted(self.done), "rejected": self.rejected}, checkpoint_file)
+        os.replace(temporary_path, self.path)
+
+
+def build_user(form, results, paths, checkpoint, image_store):
+    # The /face-register checks, rejections go to the checkpoint
+    rejected = False
+    for (analysis, error), path in zip(results, paths):
+        if error:
+            checkpoint.reject(form.student_id, error, path)
+            rejected = True
+        elif not analysis.encodings:
+            checkpoint.reject(form.student_id, "No faces detected.", path)
+            rejected = True
+    if rejected:
+        return None
+
+    encodings = [analysis.encodings[0] for analysis, _ in results]
+    issues = check_enrollment(
+        encodings, REGISTER_DUPLICATE_DISTANCE, REGISTER_CONSISTENCY_DISTANCE
+    )
+    for message, indexes in issues:
+        checkpoint.reject(form.student_id, message, ";".join(paths[i] for i in indexes))
+    if issues:
+        return None
+
+    user = User(**form.model_dump())
+    user.passport = image_store.save(results[0][0].passport)
+    user.face_templates = pack_templates(encodings, dtype=TEMPLATE_DTYPE)
+    return user
+
+
+def commit_chunk(db, users, checkpoint, template_store) -> int:
+    # Returns how many of the users were stored
+    db.add_all(users)
+    try:
+        # Flush first, the ids are needed for the delta log and reading them
+        # after the commit would reload every user
+        db.flush()
+        stored = [(user.id, user.face_templates) for user in users]
+        db.commit()
+    except IntegrityError:
+        # One bad row fails the chunk, find it by committing one at a time
+        db.rollback()
+        stored = []
+        for user in users:
+            db.add(user)
+            try:
+                db.flush()
+                row = (user.id, user.face_templates)
+                db.commit()
+            except IntegrityError as e:
+                db.rollback()
+                checkpoint.reject(user.student_id, f"Conflicts with an existing user: {e.orig}")
+                continue
+            stored.append(row)
+    for user_id, blob in stored:
+        template_store.append(user_id, blob)
+    checkpoint.done.update(user.student_id for user in users)
+    checkpoint.save()
+    return len(stored)
+
+
+def existing_students(db, forms):
+    keys = [normalize_key(form.student_id) for form in forms]
+    existing = set()
+    for start in range(0, len(keys), 500):
+        existing.update(
+            key
+            for (key,) in db.query(User.student_id_key).filter(
+                User.student_id_key.in_(keys[start : start + 500])
+            )
+        )
+    return existing
+
+
+def run(source, workers, chunk_size, checkpoint_path):
+    start = time.perf_counter()
+    checkpoint = Checkpoint(checkpoint_path)
+    image_store = ImageStore(IMAGE_STORE_DIR, PASSPORT_THUMBNAIL_SIZES)
+    template_store = TemplateStore(TEMPLATE_SNAPSHOT_DIR)
+    db = SessionLocal()
+    summary = {"students": 0, "enrolled": 0, "rejected": 0, "skipped": 0, "images": 0}
+
+    pending = []
+    for fields, paths in read_manifest(source):
+        summary["students"] += 1
+        student_id = fields.get("student_id", "")
+        if student_id in checkpoint.done:
+            summary["skipped"] += 1
+            continue
+        try:
+            form = RegisterForm.model_validate(fields)
+        except ValidationError as e:
+            checkpoint.reject(student_id, f"Invalid fields: {e.errors()}")
+            checkpoint.done.add(student_id)
+            summary["rejected"] += 1
+            continue
+        if len(paths) != IMAGES_PER_STUDENT:
+            checkpoint.reject(student_id, f"Exactly {IMAGES_PER_STUDENT} images are required.")
+            checkpoint.done.add(student_id)
+            summary["rejected"] += 1
+            continue
+        pending.append((form, paths))
+
+    existing = existing_students(db, [form for form, _ in pending])
+    summary["skipped"] += sum(
+        normalize_key(form.student_id) in existing for form, _ in pending
+    )
+    pending = [
+        (form, paths)
+        for form, paths in pending
+        if normalize_key(form.student_id) not in existing
+    ]
+
+    chunk = []
+    executor = ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=face_worker.init_worker,
+    )
+    try:
+        # Keep a bounded number of students in flight, not the whole intake
+        jobs = {}
+        queue = iter(pending)
+        while True:
+            while len(jobs) < workers * 4:
+                item = next(queue, None)
+                if item is None:
+                    break
+                jobs[executor.submit(analyze_student, item[1])] = item
+            if not jobs:
+                break
+            finished, _ = wait(jobs, return_when=FIRST_COMPLETED)
+            for job in finished:
+                form, paths = jobs.pop(job)
+                summary["images"] += len(paths)
+                user = build_user(form, job.result(), paths, checkpoint, image_store)
+                if user is None:
+                    checkpoint.done.add(form.student_id)
+                    summary["rejected"] += 1
+                    continue
+                chunk.append(user)
+                if len(chunk) >= chunk_size:
+                    enrolled = commit_chunk(db, chunk, checkpoint, template_store)
+                    summary["enrolled"] += enrolled
+                    summary["rejected"] += len(chunk) - enrolled
+                    chunk = []
+        if chunk:
+            enrolled = commit_chunk(db, chunk, checkpoint, template_store)
+            summary["enrolled"] += enrolled
+            summary["rejected"] += len(chunk) - enrolled
+        checkpoint.save()
+    finally:
+        executor.shutdown(cancel_futures=True)
+        db.close()
+
+    elapsed = time.perf_counter() - start
+    summary["seconds"] = elapsed
+    summary["images_per_second"] = summary["images"] / elapsed if elapsed else None
+    return summary, checkpoint.rejected
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("source", help="CSV manifest or directory of students")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--chunk-size", type=int, default=100, help="Users per transaction")
+    parser.add_argument(
+        "--checkpoint", help="Progress file (default: <source>.checkpoint.json)"
+    )
+    parser.add_argument("--rejected", help="Write the rejected images to this CSV")
+    args = parser.parse_args(argv)
+
+    checkpoint_path = args.checkpoint or f"{args.source.rstrip(os.sep)}.checkpoint.json"
+    summary, rejected = run(args.source, args.workers, args.chunk_size, checkpoint_path)
+
+    if args.rejected:
+        with open(args.rejected, "w", newline="") as rejected_file:
+            writer = csv.DictWriter(rejected_file, fieldnames=["student_id", "image", "reason"])
+            writer.writeheader()
+            writer.writerows(rejected)
+    else:
+        summary["rejected_images"] = rejected
+    json.dump(summary, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""
+Short-lived cache of face analyses, keyed by the uploaded image's content.
+
+Clients retry /face-auth with the same still after a transient error and the
+kiosk re-submits frames, and every one of them used to go through detection
+and encoding again. The face locations and encodings computed for an image
+are kept here under a SHA-256 of the image bytes and the pipeline's model
+version, so a resubmission goes straight to matching. Only the digest and
+the analysis are stored, never the image itself.
+
+Entries expire after ``ttl`` seconds and the least recently used entries
+are evicted once ``max_entries`` is reached. The cache is only used from
+the event loop thread, so it needs no lock.
+"""
+import hashlib
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from face_pipeline import FaceAnalysis
+
+
+def image_key(image_bytes: bytes, model_version: str) -> bytes:
+    digest = hashlib.sha256(model_version.encode())
+    digest.update(b"\0")
+    digest.update(image_bytes)
+    return digest.digest()
+
+
+class EncodingCache:
+    def __init__(self, model_version: str, max_entries=1024, ttl=30):
+        self.model_version = model_version
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.memory_bytes = 0
+        self._entries = OrderedDict()
+
+    @staticmethod
+    def _size(entry) -> int:
+        _, _, locations, encodings = entry
+        return 32 + 16 * len(locations) + sum(encoding.nbytes for encoding in encodings)
+
+    def _remove(self, key):
+        self.memory_bytes -= self._size(self._entries.pop(key))
+
+    def get(self, image_bytes: bytes) -> Optional[FaceAnalysis]:
+        if not self.max_entries:
+            return None
+        key = image_key(image_bytes, self.model_version)
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] > time.monotonic():
+            self._entries.move_to_end(key)
+            self.hits += 1
+            _, image_shape, locations, encodings = entry
+            # A fresh analysis every time, endpoints add their own timings
+            return FaceAnalysis(image_shape, list(locations), list(encodings))
+        if entry is not None:
+            self._remove(key)
+        self.misses += 1
+        return None
+
+    def put(self, image_bytes: bytes, analysis: FaceAnalysis):
+        if not self.max_entries:
+            return
+        key = image_key(image_bytes, self.model_version)
+        if key in self._entries:
+            self._remove(key)
+        encodings = tuple(analysis.encodings)
+        for encoding in encodings:
+            encoding.flags.writeable = False
+        entry = (
+            time.monotonic() + self.ttl,
+            analysis.image_shape,
+            tuple(analysis.locations),
+            encodings,
+        )
+        self._entries[key] = entry
+        self.memory_bytes += self._size(entry)
+        while len(self._entries) > self.max_entries:
+            self._remove(next(iter(self._entries)))
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "memory_bytes": self.memory_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
@@ -0,0 +1,79 @@
+"""
+Micro-batching in front of the face encoder.
+
+Under a login rush every request used to run the ResNet encoder on its own
+faces. With batching enabled the face workers stop after landmarks and send
+back aligned 150x150 chips (face_worker.locate_faces); EncodeBatcher collects
+the chips of concurrent requests for up to ``window`` seconds, or until
+``max_batch`` chips are waiting, encodes them in a single worker job
+(face_worker.encode_chips) and hands each request its own encodings.
+
+The batch is one job for the face pool, so a saturated pool fails every
+request in it with the same 503.
+"""
+import asyncio
+
+import face_worker
+import metrics
+from face_pipeline import timed
+
+
+class EncodeBatcher:
+    def __init__(self, pool, window: float, max_batch: int):
+        self.pool = pool
+        self.window = window
+        self.max_batch = max_batch
+        # (chips, future) of the requests waiting for the next batch
+        self._pending = []
+        self._size = 0
+        self._timer = None
+        self._tasks = set()
+
+    async def analyze(self, image_bytes: bytes, passport_padding=None):
+        # Same result as face_worker.analyze_image, with batched encoding
+        analysis, chips = await self.pool.run(
+            face_worker.locate_faces, image_bytes, passport_padding
+        )
+        if chips:
+            with timed(analysis.timings, "encode"):
+                analysis.encodings = await self.encode(chips)
+        return analysis
+
+    async def encode(self, chips):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((chips, future))
+        self._size += len(chips)
+        if self._size >= self.max_batch:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        pending, self._pending, self._size = self._pending, [], 0
+        if pending:
+            task = asyncio.ensure_future(self._run(pending))
+            # Keep a reference until it is done, the loop only holds a weak one
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, pending):
+        chips = [chip for request_chips, _ in pending for chip in request_chips]
+        metrics.encode_batch_size.observe(len(chips))
+        try:
+            encodings = await self.pool.run(face_worker.encode_chips, chips)
+        except Exception as e:
+            for _, future in pending:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        start = 0
+        for request_chips, future in pending:
+            # A request that was cancelled while waiting just drops its share
+            if not future.done():
+                future.set_result(encodings[start : start + len(request_chips)])
+            start += len(request_chips)
@@ -0,0 +1,301 @@
+"""
+Single-pass face verification pipeline.
+
+decode -> downscale -> detect -> landmark -> encode -> match
+
+Each stage runs once and hands its output to the next one, so an image is
+never decoded or run through the detector twice. Every stage records how long
+it took (in milliseconds) in ``FaceAnalysis.timings``.
+
+HOG cost grows with pixel count, so large camera stills are not detected at
+full size. JPEGs are decoded at a reduced scale straight from libjpeg (draft
+mode) down to at most ``encode_max_side``, detection runs on a copy of at
+most ``detect_max_side``, and the boxes are mapped back so landmarks and
+encodings are computed on a full resolution crop around each face.
+
+The first four stages need dlib and run in the face worker processes
+(see face_worker.analyze_image). With micro-batching enabled the workers
+stop after landmarks and return aligned face chips instead, which the
+server encodes in batches across requests (see face_batcher.py). ``match`` is plain NumPy and runs in the
+server process against the user's template matrix (see matcher.py).
+"""
+import math
+import time
+from importlib.metadata import PackageNotFoundError, version
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from io import BytesIO
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+from matcher import FaceMatcher, MatchResult
+
+STAGES = ("decode", "downscale", "detect", "crop", "landmark", "encode", "match")
+
+# Context kept around each face box when cropping for landmarks and encoding,
+# as a fraction of the box size. The encoder's aligned chip adds 25% padding
+# around the landmarks, this keeps that region inside the crop.
+CROP_MARGIN = 0.5
+
+# Aligned chips as the ResNet encoder takes them, the same size and padding
+# compute_face_descriptor uses when it cuts the chip itself
+CHIP_SIZE = 150
+CHIP_PADDING = 0.25
+
+
+@dataclass
+class FaceAnalysis:
+    image_shape: Tuple[int, ...]
+    # (top, right, bottom, left) in image coordinates, like face_recognition
+    locations: List[Tuple[int, int, int, int]] = field(default_factory=list)
+    encodings: List[np.ndarray] = field(default_factory=list)
+    timings: Dict[str, float] = field(default_factory=dict)
+    # JPEG crop around the first face, only when analyze() is asked for one
+    passport: Optional[bytes] = None
+
+    def server_timing(self) -> str:
+        # Value for the Server-Timing response header
+        return ", ".join(
+            f"{stage};dur={duration:.1f}" for stage, duration in self.timings.items()
+        )
+
+
+def padded_box(location, padding_percentage, size):
+    # (left, top, right, bottom) crop box around a face, clamped to the image
+    top, right, bottom, left = location
+    width, height = size
+    padding_height = int((bottom - top) * padding_percentage)
+    padding_width = int((right - left) * padding_percentage)
+    return (
+        max(0, left - padding_width),
+        max(0, top - padding_height),
+        min(width, right + padding_width),
+        min(height, bottom + padding_height),
+    )
+
+
+def synthetic_image(width=640, height=480) -> bytes:
+    # Face-like blob on a gradient, only used to run the models once at startup
+    x = np.linspace(64, 192, width, dtype=np.uint8)
+    image = Image.fromarray(np.tile(x, (height, 1))).convert("RGB")
+    draw = ImageDraw.Draw(image)
+    cx, cy = width // 2, height // 2
+    draw.ellipse((cx - 90, cy - 120, cx + 90, cy + 120), fill=(224, 172, 140))
+    for eye in (cx - 40, cx + 40):
+        draw.ellipse((eye - 14, cy - 40, eye + 14, cy - 24), fill=(40, 30, 30))
+    draw.line((cx - 40, cy + 60, cx + 40, cy + 60), fill=(120, 40, 40), width=6)
+    buffer = BytesIO()
+    image.save(buffer, format="JPEG")
+    return buffer.getvalue()
+
+
+@contextmanager
+def timed(timings: Dict[str, float], stage: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[stage] = (time.perf_counter() - start) * 1000
+
+
+class FacePipeline:
+    def __init__(
+        self,
+        upsample: int = 1,
+        num_jitters: int = 1,
+        detect_max_side: int = 640,
+        encode_max_side: int = 1600,
+        matcher=None,
+    ):
+        self.upsample = upsample
+        self.num_jitters = num_jitters
+        # 0 disables the corresponding resize
+        self.detect_max_side = detect_max_side
+        self.encode_max_side = encode_max_side
+        self.matcher = matcher or FaceMatcher()
+        self._api = None
+
+    @property
+    def api(self):
+        # face_recognition loads its models on import, only do that where
+        # the dlib stages actually run
+        if self._api is None:
+            import face_recognition.api as api
+
+            self._api = api
+        return self._api
+
+    @property
+    def model_version(self) -> str:
+        # Everything that changes the locations and encodings an image yields
+        try:
+            models = version("face_recognition_models")
+        except PackageNotFoundError:
+            models = "unknown"
+        return (
+            f"{models}/hog{self.upsample}/jitter{self.num_jitters}"
+            f"/detect{self.detect_max_side}/encode{self.encode_max_side}"
+        )
+
+    def decode(self, image_bytes: bytes) -> Image.Image:
+        image = Image.open(BytesIO(image_bytes))
+        limit = self.encode_max_side
+        if limit and max(image.size) > limit:
+            # JPEG only: decode at 1/2, 1/4 or 1/8 scale, never below the limit.
+            # libjpeg keeps both sides at or above the box, so the box has
+            # the image's aspect ratio, a square one would rule out 4:3 stills
+            scale = limit / max(image.size)
+            image.draft(
+                "RGB", (math.ceil(image.width * scale), math.ceil(image.height * scale))
+            )
+        image = image.convert("RGB") if image.mode != "RGB" else image
+        image.load()
+        if limit and max(image.size) > limit:
+            image.thumbnail((limit, limit), Image.BILINEAR)
+        return image
+
+    def downscale(self, image: Image.Image):
+        # Detection copy of the image and its scale relative to the original
+        limit = self.detect_max_side
+        width, height = image.size
+        if not limit or max(width, height) <= limit:
+            return np.asarray(image), 1.0
+        scale = limit / max(width, height)
+        small = image.resize(
+            (max(1, round(width * scale)), max(1, round(height * scale))),
+            Image.BILINEAR,
+            reducing_gap=2.0,
+        )
+        return np.asarray(small), scale
+
+    def detect(self, small: np.ndarray, scale: float, size):
+        # Face boxes as (top, right, bottom, left) in full resolution coordinates
+        width, height = size
+        return [
+            (
+                max(int(rect.top() / scale), 0),
+                min(int(rect.right() / scale), width),
+                min(int(rect.bottom() / scale), height),
+                max(int(rect.left() / scale), 0),
+            )
+            for rect in self.api._raw_face_locations(small, self.upsample, "hog")
+        ]
+
+    def landmark(self, image: Image.Image, locations):
+        # Full resolution crop around each face with its 5 point landmarks
+        import dlib
+
+        faces = []
+        for top, right, bottom, left in locations:
+            margin_y = int((bottom - top) * CROP_MARGIN)
+            margin_x = int((right - left) * CROP_MARGIN)
+            crop_left = max(0, left - margin_x)
+            crop_top = max(0, top - margin_y)
+            crop = np.asarray(
+                image.crop(
+                    (
+                        crop_left,
+                        crop_top,
+                        min(image.width, right + margin_x),
+                        min(image.height, bottom + margin_y),
+                    )
+                )
+            )
+            box = dlib.rectangle(
+                left - crop_left, top - crop_top, right - crop_left, bottom - crop_top
+            )
+            faces.append((crop, self.api.pose_predictor_5_point(crop, box)))
+        return faces
+
+    def encode(self, faces) -> List[np.ndarray]:
+        encoder = self.api.face_encoder
+        return [
+            np.array(encoder.compute_face_descriptor(crop, shape, self.num_jitters))
+            for crop, shape in faces
+        ]
+
+    def align(self, faces) -> List[np.ndarray]:
+        # 150x150 chips, encoding them gives the same result as encode()
+        import dlib
+
+        return [
+            dlib.get_face_chip(crop, shape, size=CHIP_SIZE, padding=CHIP_PADDING)
+            for crop, shape in faces
+        ]
+
+    def encode_chips(self, chips) -> List[np.ndarray]:
+        # One call to the network for the whole batch
+        if not chips:
+            return []
+        return [
+            np.array(encoding)
+            for encoding in self.api.face_encoder.compute_face_descriptor(
+                list(chips), self.num_jitters
+            )
+        ]
+
+    def crop(self, image: Image.Image, location, padding_percentage) -> bytes:
+        buffer = BytesIO()
+        image.crop(padded_box(location, padding_percentage, image.size)).save(
+            buffer, format="JPEG"
+        )
+        return buffer.getvalue()
+
+    def analyze(self, image_bytes: bytes, passport_padding=None) -> FaceAnalysis:
+        analysis, faces = self.locate(image_bytes, passport_padding)
+        if faces:
+            with timed(analysis.timings, "encode"):
+                analysis.encodings = self.encode(faces)
+        return analysis
+
+    def locate(self, image_bytes: bytes, passport_padding=None):
+        # Every stage up to and including landmarks: (analysis, faces)
+        timings = {}
+        with timed(timings, "decode"):
+            image = self.decode(image_bytes)
+        with timed(timings, "downscale"):
+            small, scale = self.downscale(image)
+        with timed(timings, "detect"):
+            locations = self.detect(small, scale, image.size)
+
+        analysis = FaceAnalysis(
+            (image.height, image.width, 3), locations, timings=timings
+        )
+        if not locations:
+            return analysis, []
+
+        if passport_padding is not None:
+            # Reuse this detection for the passport photo
+            with timed(timings, "crop"):
+                analysis.passport = self.crop(image, locations[0], passport_padding)
+
+        with timed(timings, "landmark"):
+            faces = self.landmark(image, locations)
+        return analysis, faces
+
+    def warm_up(self) -> Dict[str, float]:
+        """
+        Run every dlib stage once on a synthetic image.
+
+        The detector will usually find nothing in it, so landmarks and the
+        encoder run on a fixed box in the middle of the image instead. What
+        matters is that all three models are loaded and have paid their
+        first-call cost before real traffic arrives.
+        """
+        image_bytes = synthetic_image()
+        analysis = self.analyze(image_bytes)
+        height, width, _ = analysis.image_shape
+        box = (height // 4, width * 3 // 4, height * 3 // 4, width // 4)
+        image = self.decode(image_bytes)
+        with timed(analysis.timings, "landmark"):
+            faces = self.landmark(image, [box])
+        with timed(analysis.timings, "encode"):
+            self.encode(faces)
+        return analysis.timings
+
+    def match(self, analysis: FaceAnalysis, templates: np.ndarray) -> MatchResult:
+        # All detected faces against all templates in one batch
+        with timed(analysis.timings, "match"):
+            return self.matcher.match(templates, analysis.encodings)
@@ -0,0 +1,171 @@
+"""
+Bounded process pool for face detection and encoding.
+
+dlib releases nothing back to the event loop while it works, so running it
+inside an ``async def`` endpoint stalls every other request. The pool keeps
+that work in separate processes and caps how many jobs may be outstanding;
+once the cap is reached new jobs are rejected with a 503 and a Retry-After
+header instead of piling up behind a login rush.
+
+A worker that dies (OOM killer, a crash inside dlib) breaks the whole
+executor. The first job to see that starts a replacement pool in the
+background and /ready reports 503 until its workers have warmed up; jobs in
+the meantime get a 503 with Retry-After too.
+"""
+import asyncio
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+
+from fastapi import HTTPException, status
+
+import face_worker
+from config import (
+    FACE_WORKERS,
+    FACE_WORKERS_PER_CORE,
+    FACE_QUEUE_SIZE,
+    FACE_RETRY_AFTER,
+)
+
+
+def default_worker_count() -> int:
+    if FACE_WORKERS > 0:
+        return FACE_WORKERS
+    return max(1, int((os.cpu_count() or 1) * FACE_WORKERS_PER_CORE))
+
+
+class FacePool:
+    def __init__(self, workers: int, queue_size: int, retry_after: int):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.retry_after = retry_after
+        self.in_flight = 0
+        # Set once every worker has loaded and warmed up the models
+        self.ready = False
+        self._executor = None
+        self._warmed = None
+        # Replacing a broken executor, one at a time
+        self._recovery = None
+        self._recovery_lock = asyncio.Lock()
+
+    @property
+    def capacity(self) -> int:
+        # Jobs running on a worker plus jobs waiting for one
+        return self.workers + self.queue_size
+
+    @property
+    def queue_depth(self) -> int:
+        return max(0, self.in_flight - self.workers)
+
+    def start(self):
+        if self._executor is None:
+            # spawn rather than fork: the server process has threads running
+            context = multiprocessing.get_context("spawn")
+            # Workers that have finished warming up, shared with the workers
+            self._warmed = context.Value("i", 0)
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=context,
+                initializer=face_worker.init_worker,
+                initargs=(self._warmed,),
+            )
+
+    async def warm_up(self):
+        """
+        Start every worker and wait until each has warmed up its models.
+
+        The executor only spawns a process when a job finds no idle worker,
+        so one job per worker brings them all up. The first worker to warm up
+        may take several of those jobs, so readiness waits on the shared
+        count of warmed workers instead. Returns the pid and warm-up stage
+        timings reported by each job.
+        """
+        loop = asyncio.get_running_loop()
+        results = await asyncio.gather(
+            *(
+                loop.run_in_executor(self._executor, face_worker.warm_up)
+                for _ in range(self.workers)
+            )
+        )
+        while self._warmed.value < self.workers:
+            await asyncio.sleep(0.05)
+        self.ready = True
+        return results
+
+    def unavailable(self, detail="Face processing is not available."):
+        return HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail=detail,
+            headers={"Retry-After": str(self.retry_after)},
+        )
+
+    async def _recover(self, broken):
+        async with self._recovery_lock:
+            if self._executor is not broken:
+                # Already replaced
+                return
+            print("A face worker died, restarting the face worker pool")
+            self.ready = False
+            broken.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+            self.start()
+            try:
+                await self.warm_up()
+            except Exception as e:
+                print(f"Face worker warm-up failed: {e}")
+            else:
+                print(f"Face worker pool restarted: {self.workers} workers")
+
+    @property
+    def recovering(self) -> bool:
+        return self._recovery is not None and not self._recovery.done()
+
+    def shutdown(self):
+        self.ready = False
+        if self.recovering:
+            self._recovery.cancel()
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._executor = None
+
+    def _job_done(self, loop):
+        # Runs in the executor's thread once the job has left its worker
+        try:
+            loop.call_soon_threadsafe(self._release)
+        except RuntimeError:
+            # The loop has closed, nothing reads in_flight any more
+            pass
+
+    def _release(self):
+        self.in_flight -= 1
+
+    def _broken(self, executor):
+        self.ready = False
+        if not self.recovering:
+            self._recovery = asyncio.create_task(self._recover(executor))
+        return self.unavailable()
+
+    async def run(self, fn, *args, **kwargs):
+        if self._executor is None or self.recovering:
+            raise self.unavailable()
+        # Only the event loop thread touches in_flight, so no lock is needed
+        if self.in_flight >= self.capacity:
+            raise self.unavailable("Server is busy processing other logins. Retry shortly.")
+        loop = asyncio.get_running_loop()
+        executor = self._executor
+        try:
+            future = executor.submit(partial(fn, *args, **kwargs))
+        except BrokenProcessPool:
+            raise self._broken(executor)
+        # The slot is freed when the job is done, not when the caller stops
+        # waiting: cancelling a job that a worker already started doesn't stop it
+        self.in_flight += 1
+        future.add_done_callback(lambda _: self._job_done(loop))
+        try:
+            return await asyncio.wrap_future(future)
+        except BrokenProcessPool:
+            raise self._broken(executor)
+
+face_pool = FacePool(default_worker_count(), FACE_QUEUE_SIZE, FACE_RETRY_AFTER)
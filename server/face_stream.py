@@ -0,0 +1,57 @@
+"""
+Helpers for streaming face verification over a WebSocket (/ws/face-auth).
+
+Frames are read as fast as the client sends them but only the newest one is
+kept: if the face workers fall behind, stale frames are dropped instead of
+queued, so the server always verifies what the camera sees right now.
+"""
+import asyncio
+
+from fastapi import WebSocket, WebSocketDisconnect
+
+
+class LatestFrame:
+    def __init__(self):
+        self.frame = None
+        self.closed = False
+        self.received = 0
+        self.dropped = 0
+        self._ready = asyncio.Event()
+
+    def put(self, frame: bytes):
+        self.received += 1
+        if self.frame is not None:
+            # The previous frame was never picked up, the new one replaces it
+            self.dropped += 1
+        self.frame = frame
+        self._ready.set()
+
+    def close(self):
+        self.closed = True
+        self._ready.set()
+
+    async def get(self):
+        # Next frame to process, or None once the client has gone away
+        await self._ready.wait()
+        self._ready.clear()
+        frame, self.frame = self.frame, None
+        return frame
+
+
+async def read_frames(websocket: WebSocket, slot: LatestFrame, decode):
+    # Binary messages are raw image bytes, text messages base64 (data URLs are fine)
+    try:
+        while True:
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                break
+            if message.get("bytes") is not None:
+                slot.put(message["bytes"])
+            elif message.get("text"):
+                frame = decode(message["text"])
+                if frame:
+                    slot.put(frame)
+    except WebSocketDisconnect:
+        pass
+    finally:
+        slot.close()
@@ -0,0 +1,89 @@
+"""
+Functions that run inside the face worker processes.
+
+Importing face_recognition loads the dlib detector, shape predictor and ResNet
+encoder, so only the worker processes import it. Everything here must be a
+module level function so it can be pickled across the process boundary.
+"""
+import os
+from io import BytesIO
+
+import numpy as np
+from PIL import Image
+
+from config import FACE_DETECT_MAX_SIDE, FACE_ENCODE_MAX_SIDE, FACE_DETECT_UPSAMPLE
+from face_pipeline import FacePipeline, padded_box, timed
+
+
+pipeline = FacePipeline(
+    upsample=FACE_DETECT_UPSAMPLE,
+    detect_max_side=FACE_DETECT_MAX_SIDE,
+    encode_max_side=FACE_ENCODE_MAX_SIDE,
+)
+
+
+# Stage timings of this worker's warm-up run, in milliseconds
+warm_up_timings = {}
+
+
+def init_worker(warmed=None):
+    # Load the dlib models and run them once per worker instead of on the
+    # first request, then count this worker as warm
+    warm_up_timings.update(pipeline.warm_up())
+    if warmed is not None:
+        with warmed.get_lock():
+            warmed.value += 1
+
+
+def warm_up():
+    # Submitted once per worker at startup, the initializer does the work
+    return os.getpid(), warm_up_timings
+
+
+def analyze_image(image_bytes, passport_padding=None):
+    # decode -> detect -> landmark -> encode, each stage once
+    return pipeline.analyze(image_bytes, passport_padding)
+
+
+def locate_faces(image_bytes, passport_padding=None):
+    # Everything but the encoder: the analysis and one aligned chip per face
+    analysis, faces = pipeline.locate(image_bytes, passport_padding)
+    with timed(analysis.timings, "align"):
+        chips = pipeline.align(faces)
+    return analysis, chips
+
+
+def encode_chips(chips):
+    # A batch of chips collected from several requests (see face_batcher.py)
+    return pipeline.encode_chips(chips)
+
+
+def crop_image_with_padding(image_bytes, padding_percentage=0.2):
+    """
+    Crops an image to include the face with a padding around it.
+
+    Args:
+    image_bytes (bytes): The image data in bytes.
+    padding_percentage (float): The percentage of padding relative to the detected face dimensions.
+
+    Returns:
+    Image: The cropped image with padding.
+    """
+    from face_recognition import face_locations
+
+    if image_bytes:
+        image = Image.open(BytesIO(image_bytes))
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+        img_array = np.array(image)
+        faces = face_locations(img_array)
+
+        if faces:
+            # Take the first detected face and crop it with padding
+            return image.crop(padded_box(faces[0], padding_percentage, image.size))
+
+        else:
+            raise ValueError("No faces detected in the image.")
+    else:
+        raise ValueError("Invalid image bytes.")
+
@@ -0,0 +1,84 @@
+"""
+Content-addressed store for passport crops.
+
+Each crop is stored under the SHA-256 of its bytes, next to thumbnails
+generated once at enrollment:
+
+    <root>/<digest[:2]>/<digest>/original.jpg
+    <root>/<digest[:2]>/<digest>/<size>.jpg
+    <root>/<digest[:2]>/<digest>/<size>.webp
+
+User.passport holds the digest. A digest always names the same bytes, so
+/images/{digest} can be cached by browsers for as long as they like and
+revalidated with nothing but the ETag. Saving does disk IO and Pillow work,
+call it from a thread rather than the event loop.
+"""
+import hashlib
+import os
+import re
+from io import BytesIO
+from typing import Optional
+
+from PIL import Image, features
+
+DIGEST = re.compile(r"^[0-9a-f]{64}$")
+
+FORMATS = {
+    "jpg": ("JPEG", "image/jpeg", {"quality": 85, "optimize": True, "progressive": True}),
+    "webp": ("WEBP", "image/webp", {"quality": 80, "method": 4}),
+}
+
+
+class ImageStore:
+    def __init__(self, root: str, sizes):
+        self.root = root
+        # Longest side of each thumbnail, in pixels
+        self.sizes = tuple(sorted(sizes))
+        self.formats = [name for name in FORMATS if name != "webp" or features.check("webp")]
+
+    def directory(self, digest: str) -> str:
+        return os.path.join(self.root, digest[:2], digest)
+
+    def path(self, digest: str, size: Optional[int] = None, format: str = "jpg") -> Optional[str]:
+        # None for anything that is not a stored image, digests are never
+        # joined into a path before they are validated
+        if not DIGEST.match(digest) or format not in self.formats:
+            return None
+        if size is None:
+            name = "original.jpg"
+        elif size in self.sizes:
+            name = f"{size}.{format}"
+        else:
+            return None
+        path = os.path.join(self.directory(digest), name)
+        return path if os.path.exists(path) else None
+
+    def save(self, jpeg_bytes: bytes) -> str:
+        digest = hashlib.sha256(jpeg_bytes).hexdigest()
+        directory = self.directory(digest)
+        if os.path.exists(os.path.join(directory, "original.jpg")):
+            # Same bytes, same thumbnails, nothing to do
+            return digest
+        os.makedirs(directory, exist_ok=True)
+
+        image = Image.open(BytesIO(jpeg_bytes))
+        image = image.convert("RGB") if image.mode != "RGB" else image
+        for size in self.sizes:
+            thumbnail = image.copy()
+            thumbnail.thumbnail((size, size), Image.LANCZOS)
+            for name in self.formats:
+                pillow_format, _, options = FORMATS[name]
+                buffer = BytesIO()
+                thumbnail.save(buffer, format=pillow_format, **options)
+                self._write(os.path.join(directory, f"{size}.{name}"), buffer.getvalue())
+        # The original goes last, its presence marks the entry as complete
+        self._write(os.path.join(directory, "original.jpg"), jpeg_bytes)
+        return digest
+
+    @staticmethod
+    def _write(path: str, data: bytes):
+        # Write then rename so readers never see a partial file
+        temporary_path = f"{path}.tmp"
+        with open(temporary_path, "wb") as image_file:
+            image_file.write(data)
+        os.replace(temporary_path, path)
@@ -1,26 +1,128 @@
-from fastapi import FastAPI, File, UploadFile, Depends, HTTPException, status, WebSocket, Request
+from fastapi import FastAPI, Depends, HTTPException, status, WebSocket, Request
+import asyncio
+import time
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
-from fastapi.encoders import jsonable_encoder
-from face_recognition import load_image_file, face_encodings, face_landmarks, face_locations, compare_faces
+from fastapi.responses import FileResponse, JSONResponse, Response
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
 import numpy as np
-import os
-import bcrypt
-import base64
-from typing import List
-from io import BytesIO
-from PIL import Image, UnidentifiedImageError
+import hmac
+from typing import Literal, Optional
+from PIL import UnidentifiedImageError
 from sqlalchemy.orm import Session as SQLSession
-from config import SessionLocal
-from models.user import User
+from config import (
+    SessionLocal,
+    get_db,
+    get_async_db,
+    FACE_INDEX_IVF_THRESHOLD,
+    FACE_INDEX_NPROBE,
+    TEMPLATE_DTYPE,
+    STREAM_REQUIRED_FRAMES,
+    STREAM_MAX_FRAMES,
+    STREAM_TIMEOUT,
+    REGISTER_DUPLICATE_DISTANCE,
+    REGISTER_CONSISTENCY_DISTANCE,
+    ENCODING_CACHE_SIZE,
+    ENCODING_CACHE_TTL,
+    FACE_BATCH_WINDOW_MS,
+    FACE_BATCH_MAX,
+    IMAGE_STORE_DIR,
+    PASSPORT_THUMBNAIL_SIZES,
+    FACE_QUALITY_GATE,
+    FACE_MIN_IMAGE_SIDE,
+    FACE_MIN_BRIGHTNESS,
+    FACE_MAX_BRIGHTNESS,
+    FACE_MAX_CLIPPED,
+    FACE_MIN_SHARPNESS,
+    RATE_LIMIT_BACKEND,
+    RATE_LIMIT_REDIS_URL,
+    RATE_LIMIT_IP_RATE,
+    RATE_LIMIT_IP_BURST,
+    RATE_LIMIT_IDENTITY_RATE,
+    RATE_LIMIT_IDENTITY_BURST,
+    RATE_LIMIT_TRUST_PROXY,
+    FACE_MAX_CONCURRENT,
+    IDENTIFY_API_KEY,
+    TEMPLATE_SNAPSHOT_DIR,
+    TEMPLATE_REFRESH_INTERVAL,
+    TEMPLATE_COMPACT_USERS,
+)
+from models.user import User, normalize_key
 from models.session import Session
-from pydantic import BaseModel
-from session import create_user_session, get_current_user, invalidate_user_session
-from datetime import datetime
-from sqlalchemy import func
-
-
-app = FastAPI()
+from schemas import (
+    IdentifyRequest,
+    LoginForm,
+    LoginRequest,
+    RegisterForm,
+    RegisterRequest,
+    TokenRequest,
+)
+from session import (
+    create_user_session,
+    get_current_user,
+    invalidate_user_session,
+    verify_user_session,
+    resolve_session,
+    session_cache,
+    signer,
+    denylist,
+    flush_denylist_periodically,
+    reap_expired_sessions_periodically,
+)
+from session_cache import CurrentUser
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from fastapi.concurrency import run_in_threadpool
+from contextlib import asynccontextmanager, nullcontext
+from face_pool import face_pool
+from face_pipeline import FacePipeline, timed
+from matcher import FaceMatcher, check_enrollment
+from face_index import FaceIndex
+from template_snapshot import TemplateStore
+from encoding_cache import EncodingCache
+from face_batcher import EncodeBatcher
+from image_store import FORMATS, ImageStore
+from quality import ImageRejected, QualityGate
+from rate_limit import MemoryBackend, RateLimiter, RedisBackend
+from face_stream import LatestFrame, read_frames
+from uploads import read_face_upload, safe_b64decode
+from templates import pack_templates, unpack_templates
+import face_worker
+import metrics
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Start the face workers with the app so the models are loaded before traffic
+    started = time.perf_counter()
+    face_pool.start()
+    load_face_index()
+    warm_up_task = asyncio.create_task(warm_up_face_pool(started))
+    reaper_task = asyncio.create_task(reap_expired_sessions_periodically())
+    refresh_task = asyncio.create_task(refresh_face_index_periodically())
+    flush_task = None
+    if signer:
+        denylist.sync()
+        flush_task = asyncio.create_task(flush_denylist_periodically())
+    yield
+    warm_up_task.cancel()
+    reaper_task.cancel()
+    refresh_task.cancel()
+    if flush_task:
+        flush_task.cancel()
+        denylist.sync()
+    face_pool.shutdown()
+
+
+app = FastAPI(lifespan=lifespan)
+
+
+@app.exception_handler(ImageRejected)
+async def image_rejected(request: Request, exc: ImageRejected):
+    # detail stays a readable message for the client, reason is the code
+    request.state.outcome = exc.reason
+    return JSONResponse(
+        status_code=422, content={"detail": exc.message, "reason": exc.reason}
+    )
 
 
 # Add CORS middleware to allow connections from your React application's domain
@@ -31,245 +133,645 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(metrics.MetricsMiddleware)
+
+
+# Only the match stage runs in this process, the rest runs in the face workers
+matcher = FaceMatcher(tolerance=0.4, required_matches=3)
+pipeline = FacePipeline(matcher=matcher)
+# face_templates.index is the 1:N index, mapped from the shared snapshot
+face_templates = TemplateStore(
+    TEMPLATE_SNAPSHOT_DIR,
+    lambda: FaceIndex(
+        ivf_threshold=FACE_INDEX_IVF_THRESHOLD, nprobe=FACE_INDEX_NPROBE, matcher=matcher
+    ),
+)
+
 
+# Keyed on the workers' pipeline settings, they produce the cached encodings
+encoding_cache = EncodingCache(
+    face_worker.pipeline.model_version,
+    max_entries=ENCODING_CACHE_SIZE,
+    ttl=ENCODING_CACHE_TTL,
+)
 
-class LoginRequest(BaseModel):
-    # username: str
-    student_id: str
-    matriculation_number: str
-    face_encoding: str
+image_store = ImageStore(IMAGE_STORE_DIR, PASSPORT_THUMBNAIL_SIZES)
 
+# Only set when FACE_QUALITY_GATE is on
+quality_gate = (
+    QualityGate(
+        min_side=FACE_MIN_IMAGE_SIDE,
+        min_brightness=FACE_MIN_BRIGHTNESS,
+        max_brightness=FACE_MAX_BRIGHTNESS,
+        max_clipped=FACE_MAX_CLIPPED,
+        min_sharpness=FACE_MIN_SHARPNESS,
+    )
+    if FACE_QUALITY_GATE
+    else None
+)
 
-class TokenRequest(BaseModel):
-    token: str
+# Only set when FACE_BATCH_WINDOW_MS is non-zero
+encode_batcher = (
+    EncodeBatcher(face_pool, FACE_BATCH_WINDOW_MS / 1000, FACE_BATCH_MAX)
+    if FACE_BATCH_WINDOW_MS > 0
+    else None
+)
 
+# None when RATE_LIMIT_BACKEND is "off"
+rate_limiter = (
+    RateLimiter(
+        RedisBackend(RATE_LIMIT_REDIS_URL) if RATE_LIMIT_BACKEND == "redis" else MemoryBackend(),
+        ip_rate=RATE_LIMIT_IP_RATE,
+        ip_burst=RATE_LIMIT_IP_BURST,
+        identity_rate=RATE_LIMIT_IDENTITY_RATE,
+        identity_burst=RATE_LIMIT_IDENTITY_BURST,
+        max_concurrent=FACE_MAX_CONCURRENT,
+        trusted_proxies=RATE_LIMIT_TRUST_PROXY,
+    )
+    if RATE_LIMIT_BACKEND != "off"
+    else None
+)
+# read_face_upload's admit hook, the per-student_id limit
+admit_student = rate_limiter.check_form if rate_limiter else None
 
-class RegisterRequest(BaseModel):
-    # username: str
-    # fullname: str
-    # bio: str
-    student_id: str
-    matriculation_number: str
-    firstname: str
-    middlename: str
-    lastname: str
-    date_of_birth: str
-    email: str
-    phone_number: str
-    faculty: str
-    department: str
-    level: str
-    academic_session: str
-    face_encodings: List[str]
+metrics.register_runtime(
+    face_pool,
+    {"session": session_cache, "templates": matcher, "encodings": encoding_cache},
+)
 
 
-def get_db():
+def load_face_index():
+    # Map the template snapshot. Every user is only read from the database
+    # when the snapshot is missing or behind, face_register keeps it current.
     db = SessionLocal()
     try:
-        yield db
+        newest_user_id = db.query(func.max(User.id)).scalar() or 0
+        rows = db.query(User.id, User.face_templates).yield_per(1000)
+        face_templates.load(
+            newest_user_id,
+            ((user_id, unpack_templates(blob)) for user_id, blob in rows if blob),
+        )
     finally:
         db.close()
 
 
-# @app.get("/")
-# def home():
-#     return {"message": "Hello World!"}
-
+async def refresh_face_index_periodically():
+    # Pick up users registered through other server processes, and fold the
+    # delta log into a new snapshot once it has grown
+    while True:
+        await asyncio.sleep(TEMPLATE_REFRESH_INTERVAL)
+        try:
+            face_templates.refresh()
+            if face_templates.index.added_users >= TEMPLATE_COMPACT_USERS:
+                await asyncio.to_thread(face_templates.compact)
+        except Exception as e:
+            print(f"Error refreshing the face index: {e}")
 
-def verify_face_encoding(
-    user_encodings, incoming_encoding, tolerance=0.4, required_matches=3
-):
-    # Convert user encodings from a list of lists to a list of numpy arrays
-    known_encodings = [np.array(encoding) for encoding in user_encodings]
 
-    # Compare the incoming face encoding against each of the known encodings
-    comparison_results = compare_faces(
-        known_encodings, incoming_encoding, tolerance=tolerance
-    )
+def face_slot():
+    # One of the FACE_MAX_CONCURRENT slots for face work, 429 when none is left
+    return rate_limiter.face_slot() if rate_limiter else nullcontext()
 
-    # Count the number of True results indicating a match
-    match_count = sum(comparison_results)
 
-    # Check if the number of matches meets the required threshold
-    return match_count >= required_matches
+async def face_admission(request: Request):
+    # Dependency of the face endpoints, runs before the body is read
+    if rate_limiter:
+        await rate_limiter.check_ip(request)
+    async with face_slot():
+        yield
 
 
-def process_image_and_verify(request, user):
-    # Decode the face encoding from base64 to an image array
-    image_data = safe_b64decode(request.face_encoding)
-    face_image = load_image_file(BytesIO(image_data))
-    face_encodings_in_image = face_encodings(face_image)
+def kiosk_key(request: Request):
+    # Dependency of /face-identify when IDENTIFY_API_KEY is set
+    if IDENTIFY_API_KEY and not hmac.compare_digest(
+        request.headers.get("x-kiosk-key", "").encode(), IDENTIFY_API_KEY.encode()
+    ):
+        raise HTTPException(status_code=401, detail="Invalid kiosk key.")
 
-    if len(face_encodings_in_image) == 0:
-        raise HTTPException(status_code=400, detail="No faces detected in the image.")
 
-    # Initialize verification status
-    is_verified = False
+async def check_quality(image_bytes: bytes, image=None):
+    # Unusable frames get a 422 here instead of a worker slot
+    if not quality_gate:
+        return
+    with metrics.quality_check_seconds.time():
+        try:
+            await asyncio.to_thread(quality_gate.check, image_bytes, image)
+        except ImageRejected as e:
+            metrics.record_rejection(e.reason)
+            raise
+
+
+async def analyze_face(image_bytes: bytes):
+    # A resubmitted image skips the face workers and goes straight to matching
+    timings = {}
+    with timed(timings, "cache"):
+        analysis = encoding_cache.get(image_bytes)
+    if analysis is None:
+        try:
+            with timed(timings, "quality"):
+                await check_quality(image_bytes)
+            if encode_batcher:
+                analysis = await encode_batcher.analyze(image_bytes)
+            else:
+                analysis = await face_pool.run(face_worker.analyze_image, image_bytes)
+        except UnidentifiedImageError:
+            raise HTTPException(
+                status_code=422,
+                detail="Cannot identify the image. Ensure the image is valid and supported.",
+            )
+        metrics.pipeline_cost.observe(sum(analysis.timings.values()) / 1000)
+        encoding_cache.put(image_bytes, analysis)
+    analysis.timings = {**timings, **analysis.timings}
+    return analysis
 
-    # Check each detected face encoding against the stored user encodings
-    for incoming_encoding in face_encodings_in_image:
-        if verify_face_encoding(user.face_encodings, incoming_encoding):
-            is_verified = True
-            break  # Stop checking if a match is found
 
-    return is_verified
+async def warm_up_face_pool(started: float):
+    # /ready reports 503 until this has finished
+    try:
+        results = await face_pool.warm_up()
+    except Exception as e:
+        print(f"Face worker warm-up failed: {e}")
+        return
+    slowest = max(sum(timings.values()) for _, timings in results)
+    print(
+        f"Face workers ready: {face_pool.workers} workers, "
+        f"startup {time.perf_counter() - started:.2f}s, "
+        f"slowest warm-up inference {slowest:.0f}ms"
+    )
 
 
-@app.post("/face-auth")
-async def face_auth(request: LoginRequest, db: SQLSession = Depends(get_db)):
-    # Retrieve user by student_id
-    user = (
+def find_user(db: SQLSession, student_id: str, matriculation_number: str):
+    return (
         db.query(User)
         .filter(
-            func.lower(User.student_id) == func.lower(request.student_id),
-            func.lower(User.matriculation_number)
-            == func.lower(request.matriculation_number),
+            User.student_id_key == normalize_key(student_id),
+            User.matriculation_number_key == normalize_key(matriculation_number),
         )
         .first()
     )
 
+
+async def find_user_async(db: AsyncSession, student_id: str, matriculation_number: str):
+    return await db.scalar(
+        select(User).where(
+            User.student_id_key == normalize_key(student_id),
+            User.matriculation_number_key == normalize_key(matriculation_number),
+        )
+    )
+
+
+# @app.get("/")
+# def home():
+#     return {"message": "Hello World!"}
+
+
+@app.post("/face-auth")
+async def face_auth(
+    request: Request,
+    db: SQLSession = Depends(get_db),
+    async_db: AsyncSession = Depends(get_async_db),
+    _admitted: None = Depends(face_admission),
+):
+    # Stage timings for the Server-Timing header and /metrics
+    timings = request.state.timings
+
+    # JSON with a base64 image, multipart, or a raw image body
+    form, images = await read_face_upload(
+        request,
+        LoginForm,
+        LoginRequest,
+        "face_encoding",
+        allow_raw=True,
+        timings=timings,
+        admit=admit_student,
+    )
+    # A multipart body can come without the file part, or with it as a text field
+    if len(images) != 1:
+        raise HTTPException(status_code=400, detail="Exactly one image is required.")
+    (image_data,) = images
+
+    # Retrieve user by student_id
+    with timed(timings, "db"):
+        user = await find_user_async(async_db, form.student_id, form.matriculation_number)
+
     if not user:
         raise HTTPException(status_code=404, detail="User not found.")
 
-    # Decode the face encoding from base64 to an image array
-    image_data = safe_b64decode(request.face_encoding)
-    face_image = load_image_file(BytesIO(image_data))
-    face_encodings_in_image = face_encodings(face_image)
+    if not image_data:
+        raise HTTPException(status_code=400, detail="Invalid image encoding.")
 
-    if len(face_encodings_in_image) == 0:
-        raise HTTPException(status_code=400, detail="No faces detected in the image.")
+    templates = matcher.cached(user.id)
+    if templates is None:
+        with timed(timings, "templates"):
+            blob = await async_db.scalar(
+                select(User.face_templates).where(User.id == user.id)
+            )
+            templates = matcher.store(user.id, unpack_templates(blob))
+    # Hand the pooled connection back before the face work, only user.id is
+    # used from here on
+    await async_db.close()
+
+    # Detect, landmark and encode the image exactly once in a face worker
+    analysis = await analyze_face(image_data)
+    timings.update(analysis.timings)
+    analysis.timings = timings
+
+    if len(analysis.encodings) == 0:
+        request.state.outcome = "no_face"
+        raise HTTPException(
+            status_code=400,
+            detail="No faces detected in the image.",
+            headers={"Server-Timing": analysis.server_timing()},
+        )
 
-    # Check if the provided face encoding matches any of the stored encodings
-    is_verified = process_image_and_verify(request, user)
+    # Check if any detected face matches the stored encodings
+    match = pipeline.match(analysis, templates)
 
-    if is_verified:
-        session_token = create_user_session(user, db)
-        response = JSONResponse(content={"message": "Successful login."})
+    if match.is_match:
+        # The session insert is a write, keep it off the event loop
+        with timed(timings, "session"):
+            session_token = await run_in_threadpool(create_user_session, user, db)
+        response = JSONResponse(
+            content={"message": "Successful login."},
+            headers={"Server-Timing": analysis.server_timing()},
+        )
         response.set_cookie(key="session_token", value=session_token, httponly=True, secure=True, samesite='Lax')
         return response
     else:
-        raise HTTPException(status_code=401, detail="Facial Biometrics failed. Retry!")
+        raise HTTPException(
+            status_code=401,
+            detail="Facial Biometrics failed. Retry!",
+            headers={"Server-Timing": analysis.server_timing()},
+        )
 
 
-def safe_b64decode(image_data: str) -> bytes:
-    # Remove metadata if present
-    if image_data.startswith("data:image/jpeg;base64,"):
-        image_data = image_data.replace("data:image/jpeg;base64,", "")
-    elif image_data.startswith("data:image/png;base64,"):
-        image_data = image_data.replace("data:image/png;base64,", "")
+@app.websocket("/ws/face-auth")
+async def face_auth_stream(websocket: WebSocket, db: SQLSession = Depends(get_db)):
+    """
+    Streaming login. The client sends {"student_id", "matriculation_number"}
+    as the first JSON message, then camera frames as binary (or base64 text)
+    messages. The server answers every processed frame with a progress message
+    and sends the session token as soon as STREAM_REQUIRED_FRAMES consecutive
+    frames match. The token can be turned into the usual cookie via /set-session.
+    Every analysed frame is charged to the rate limits like a /face-auth
+    request, so a stream is no cheaper than the same number of logins.
+    """
+    await websocket.accept()
+    credentials = await websocket.receive_json()
+    student_id = str(credentials.get("student_id", ""))
+
+    async def admit_frame():
+        # False once the client is over a limit, the stream is then closed
+        if not rate_limiter:
+            return True
+        try:
+            await rate_limiter.check_ip(websocket)
+            await rate_limiter.check_identity(student_id)
+        except HTTPException as e:
+            metrics.request_outcomes.labels("face_auth_stream", "rate_limited").inc()
+            await websocket.send_json(
+                {
+                    "status": "error",
+                    "detail": e.detail,
+                    "retry_after": int(e.headers["Retry-After"]),
+                }
+            )
+            await websocket.close(code=status.WS_1013_TRY_AGAIN_LATER)
+            return False
+        return True
+
+    # This charge pays for the first frame
+    if not await admit_frame():
+        return
+    prepaid = True
+    # The blocking queries run in the threadpool, not on the event loop
+    user = await run_in_threadpool(
+        find_user,
+        db,
+        student_id,
+        str(credentials.get("matriculation_number", "")),
+    )
+    if not user:
+        metrics.request_outcomes.labels("face_auth_stream", "not_found").inc()
+        await websocket.send_json({"status": "error", "detail": "User not found."})
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+
+    templates = await run_in_threadpool(matcher.templates_for, user)
+    # Don't hold a pooled connection for the whole stream, only user.id is
+    # used from here on and the session reconnects for the login
+    await run_in_threadpool(db.close)
+    slot = LatestFrame()
+    reader = asyncio.create_task(read_frames(websocket, slot, safe_b64decode))
+    processed = 0
+    consecutive = 0
 
-    # Ensure padding is correct
-    padding = len(image_data) % 4
-    if padding:
-        image_data += "=" * (4 - padding)
     try:
-        return base64.b64decode(image_data)
-    except Exception as e:
-        print(f"Decoding error: {e}")
-        return None
+        async with asyncio.timeout(STREAM_TIMEOUT):
+            while processed < STREAM_MAX_FRAMES:
+                frame = await slot.get()
+                if frame is None:
+                    if slot.closed:
+                        return
+                    continue
+
+                if prepaid:
+                    prepaid = False
+                elif not await admit_frame():
+                    return
+
+                try:
+                    async with face_slot():
+                        analysis = await analyze_face(frame)
+                except HTTPException as e:
+                    if e.status_code in (
+                        status.HTTP_429_TOO_MANY_REQUESTS,
+                        status.HTTP_503_SERVICE_UNAVAILABLE,
+                    ):
+                        # Workers or slots are saturated, skip this frame and wait for a newer one
+                        continue
+                    # Undecodable frame, it counts against the stream like any rejected frame
+                    processed += 1
+                    consecutive = 0
+                    await websocket.send_json(
+                        {"status": "rejected", "reason": "undecodable", "detail": e.detail}
+                    )
+                    continue
+                except ImageRejected as e:
+                    processed += 1
+                    consecutive = 0
+                    await websocket.send_json(
+                        {"status": "rejected", "reason": e.reason, "detail": e.message}
+                    )
+                    continue
+                except Exception:
+                    analysis = None
+                processed += 1
+                if analysis:
+                    metrics.observe_timings("face_auth_stream", analysis.timings)
+
+                matched = bool(analysis and analysis.encodings) and (
+                    pipeline.match(analysis, templates).is_match
+                )
+                consecutive = consecutive + 1 if matched else 0
+
+                if consecutive >= STREAM_REQUIRED_FRAMES:
+                    metrics.request_outcomes.labels("face_auth_stream", "success").inc()
+                    session_token = await run_in_threadpool(create_user_session, user, db)
+                    await websocket.send_json(
+                        {
+                            "status": "authenticated",
+                            "message": "Successful login.",
+                            "session_token": session_token,
+                            "frames": processed,
+                            "dropped": slot.dropped,
+                        }
+                    )
+                    await websocket.close()
+                    return
+
+                await websocket.send_json(
+                    {
+                        "status": "verifying",
+                        "faces": len(analysis.encodings) if analysis else 0,
+                        "matched": matched,
+                        "consecutive": consecutive,
+                        "timings": analysis.timings if analysis else {},
+                    }
+                )
+    except TimeoutError:
+        pass
+    finally:
+        reader.cancel()
+
+    if not slot.closed:
+        metrics.request_outcomes.labels("face_auth_stream", "unauthorized").inc()
+        await websocket.send_json(
+            {"status": "failed", "detail": "Facial Biometrics failed. Retry!"}
+        )
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+
+
+@app.post("/set-session")
+def set_session(request: TokenRequest, db: SQLSession = Depends(get_db)):
+    # Exchange a token issued over /ws/face-auth for the httponly session cookie
+    if not resolve_session(request.token, db):
+        raise HTTPException(status_code=401, detail="Invalid or expired session.")
+    response = JSONResponse(content={"message": "Successful login."})
+    response.set_cookie(key="session_token", value=request.token, httponly=True, secure=True, samesite='Lax')
+    return response
+
+
+@app.post("/face-identify")
+async def face_identify(
+    request: IdentifyRequest,
+    http_request: Request,
+    db: SQLSession = Depends(get_db),
+    _kiosk: None = Depends(kiosk_key),
+    _admitted: None = Depends(face_admission),
+):
+    timings = http_request.state.timings
+    with timed(timings, "base64"):
+        image_data = safe_b64decode(request.face_encoding)
+    if not image_data:
+        raise HTTPException(status_code=400, detail="Invalid image encoding.")
+    analysis = await analyze_face(image_data)
+    timings.update(analysis.timings)
+    analysis.timings = timings
+
+    if len(analysis.encodings) == 0:
+        http_request.state.outcome = "no_face"
+        raise HTTPException(
+            status_code=400,
+            detail="No faces detected in the image.",
+            headers={"Server-Timing": analysis.server_timing()},
+        )
+
+    # Identify the largest face in the frame, that is the person at the kiosk
+    areas = [
+        (bottom - top) * (right - left)
+        for top, right, bottom, left in analysis.locations
+    ]
+    probe = analysis.encodings[int(np.argmax(areas))]
+
+    with timed(analysis.timings, "identify"):
+        candidates = face_templates.index.search(probe, k=request.top_k)
+    # Anyone can call this, so nearest neighbours that don't match stay anonymous
+    candidates = [candidate for candidate in candidates if candidate.is_match]
+
+    with timed(timings, "db"):
+        users = {
+            user.id: user
+            for user in db.query(
+                User.id, User.student_id, User.firstname, User.lastname
+            ).filter(User.id.in_([candidate.user_id for candidate in candidates]))
+        }
+    matches = [
+        {
+            "student_id": users[candidate.user_id].student_id,
+            "firstname": users[candidate.user_id].firstname,
+            "lastname": users[candidate.user_id].lastname,
+            "distance": candidate.distance,
+            "is_match": candidate.is_match,
+        }
+        for candidate in candidates
+        if candidate.user_id in users
+    ]
+    return JSONResponse(
+        content={"matches": matches},
+        headers={"Server-Timing": analysis.server_timing()},
+    )
 
 
 @app.post("/face-register")
 async def face_register(
-    request: RegisterRequest, db: SQLSession = Depends(get_db)
-):  # Check if user already exists
-    existing_user = (
-        db.query(User)
-        .filter(
-            func.lower(User.student_id) == func.lower(request.student_id),
-            func.lower(User.matriculation_number)
-            == func.lower(request.matriculation_number),
-        )
-        .first()
+    request: Request,
+    db: SQLSession = Depends(get_db),
+    _admitted: None = Depends(face_admission),
+):
+    # JSON with base64 images or multipart with the images as files
+    form, images = await read_face_upload(
+        request,
+        RegisterForm,
+        RegisterRequest,
+        "face_encodings",
+        max_images=5,
+        timings=request.state.timings,
+        admit=admit_student,
     )
 
+    # Check if user already exists
+    existing_user = find_user(db, form.student_id, form.matriculation_number)
+
     if existing_user:
         # User already exists, no need to proceed
         return {
-            "message": f"{request.student_id} is already registered. Proceed to login."
+            "message": f"{form.student_id} is already registered. Proceed to login."
         }
 
     # User doesn't exist, proceed with registration
-    if len(request.face_encodings) != 5:
+    if len(images) != 5:
         raise HTTPException(status_code=400, detail="Exactly 5 images are required.")
 
     # db = SessionLocal()
 
-    # Prepare the directory for storing images
-    image_directory = f"./../client/src/assets/user/{request.student_id}"
-    if not os.path.exists(image_directory):
-        os.makedirs(image_directory)
-
     user = User(
-        student_id=request.student_id,
-        matriculation_number=request.matriculation_number,
-        firstname=request.firstname,
-        lastname=request.lastname,
-        date_of_birth=request.date_of_birth,
-        email=request.email,
-        phone_number=request.phone_number,
-        faculty=request.faculty,
-        department=request.department,
-        level=request.level,
-        academic_session=request.academic_session,
-        face_encodings=[]
+        student_id=form.student_id,
+        matriculation_number=form.matriculation_number,
+        firstname=form.firstname,
+        lastname=form.lastname,
+        date_of_birth=form.date_of_birth,
+        email=form.email,
+        phone_number=form.phone_number,
+        faculty=form.faculty,
+        department=form.department,
+        level=form.level,
+        academic_session=form.academic_session,
     )
 
     db.add(user)
 
-    # Process and store the first image as the passport photo with padding
-    image_data = request.face_encodings[0]
-    image_bytes = safe_b64decode(image_data)
-    if image_bytes:
-        try:
-            face_image = crop_image_with_padding(image_bytes, padding_percentage=0.5)
-            face_path = os.path.join(
-                image_directory, f"passport.jpg"
-            )
-            face_image.save(face_path)
-            user.passport = face_path  # Store the path in the database
-        except ValueError as e:
-            db.rollback()
-            raise HTTPException(status_code=422, detail=str(e))
-
-    for index, image_data in enumerate(request.face_encodings):
-        image_bytes = safe_b64decode(image_data)
+    for index, image_bytes in enumerate(images):
         if image_bytes is None:
             db.rollback()
             raise HTTPException(
-                status_code=400, detail="Invalid base64 encoding in image {index + 1}."
+                status_code=400, detail=f"Invalid base64 encoding in image {index + 1}."
             )
 
-        try:
-            image = Image.open(BytesIO(image_bytes))
-            if image.mode != 'RGB':
-                image = image.convert('RGB')
-        except UnidentifiedImageError:
-            db.rollback()
-            raise HTTPException(
-                status_code=422,
-                detail=f"Cannot identify image {index + 1}. Ensure the image is valid and supported.",
-            )
-
-        image_array = np.array(image)
-        encodings = face_encodings(image_array)
-
-        if len(encodings) == 0:
-            db.rollback()  # Roll back the transaction if any image is invalid
-            raise HTTPException(
-                status_code=422,
-                detail=f"No faces detected in image {index + 1}. Please ensure the image clearly shows a face.",
-            )
+    async def analyze(index, image_bytes):
+        await check_quality(image_bytes, image=index + 1)
+        # The first image also yields the passport crop from the same detection
+        analysis = await face_pool.run(
+            face_worker.analyze_image,
+            image_bytes,
+            passport_padding=0.5 if index == 0 else None,
+        )
+        # Every image is its own pass through the pipeline
+        metrics.observe_timings("face_register", analysis.timings)
+        return index, analysis
+
+    # Fan the images out across the face workers and stop at the first bad one
+    jobs = [
+        asyncio.ensure_future(analyze(index, image_bytes))
+        for index, image_bytes in enumerate(images)
+    ]
+    analyses = [None] * len(images)
+    try:
+        for job in asyncio.as_completed(jobs):
+            try:
+                index, analysis = await job
+            except UnidentifiedImageError:
+                raise HTTPException(
+                    status_code=422,
+                    detail="Cannot identify one of the images. Ensure the images are valid and supported.",
+                )
+            if len(analysis.encodings) == 0:
+                request.state.outcome = "no_face"
+                raise HTTPException(
+                    status_code=422,
+                    detail=f"No faces detected in image {index + 1}. Please ensure the image clearly shows a face.",
+                )
+            analyses[index] = analysis
+    except Exception:
+        # Jobs still waiting for a worker are dropped, not run
+        for job in jobs:
+            job.cancel()
+        db.rollback()  # Roll back the transaction if any image is invalid
+        raise
+
+    # Assuming we only take the first encoding for simplicity
+    encodings = [analysis.encodings[0] for analysis in analyses]
+
+    # Reject duplicate frames and images that don't look like the others,
+    # using the same distances the matcher would compute
+    issues = check_enrollment(
+        encodings, REGISTER_DUPLICATE_DISTANCE, REGISTER_CONSISTENCY_DISTANCE
+    )
+    if issues:
+        db.rollback()
+        raise HTTPException(
+            status_code=422,
+            detail=" ".join(message for message, _ in issues)
+            + " Please capture five distinct images of your face.",
+        )
 
-        # Assuming we only take the first encoding for simplicity
-        user.face_encodings.append(
-            encodings[0].tolist()
-        )  # Convert numpy array to list for JSON serialization
+    # Store the first image's face crop as the passport photo, by its digest
+    user.passport = await asyncio.to_thread(image_store.save, analyses[0].passport)
 
+    user.face_templates = pack_templates(encodings, dtype=TEMPLATE_DTYPE)
     db.commit()  # Commit the transaction
+    matcher.invalidate(user.id)
+    face_templates.append(user.id, user.face_templates)
+    face_templates.refresh()
     return {"message": "Faces registered for user {}".format(user.student_id)}
 
 
+@app.get("/images/{digest}")
+def get_image(
+    request: Request,
+    digest: str,
+    size: Optional[int] = None,
+    format: Literal["jpg", "webp"] = "jpg",
+):
+    # Without a size this is the enrollment crop, always a JPEG
+    if size is None:
+        format = "jpg"
+    path = image_store.path(digest, size, format)
+    if path is None:
+        raise HTTPException(status_code=404, detail="Image not found.")
+
+    # The digest pins the content, so the ETag never changes and the
+    # response can be cached for good
+    etag = f'"{digest}-{size or "original"}.{format}"'
+    headers = {
+        "ETag": etag,
+        "Cache-Control": "private, max-age=31536000, immutable",
+    }
+    if etag in request.headers.get("if-none-match", ""):
+        return Response(status_code=304, headers=headers)
+    return FileResponse(path, media_type=FORMATS[format][1], headers=headers)
+
+
 @app.post("/logout")
 def logout(request: Request, db: SQLSession = Depends(get_db)):
     if not invalidate_user_session(request, db):
@@ -280,7 +782,7 @@ def logout(request: Request, db: SQLSession = Depends(get_db)):
 
 
 @app.post("/user-data")
-def get_user_data(current_user: User = Depends(get_current_user)):
+def get_user_data(current_user: CurrentUser = Depends(get_current_user)):
     try:
         # Attempt to construct the user data response
         user_data_response = {
@@ -311,60 +813,38 @@ def get_user_data(current_user: User = Depends(get_current_user)):
 
 
 @app.post("/validate-token")
-def validate_token(request: Request, db: SQLSession = Depends(get_db)):
-    # Check if the token is valid
-    session = db.query(Session).filter(Session.session_token == request.cookies.get("session_token")).first()
-    if session and session.expiration > datetime.utcnow():
-        return {"isValid": True}
-    return {"isValid": False}
+async def validate_token(request: Request, db: AsyncSession = Depends(get_async_db)):
+    # Check if the token is valid, answered from the session cache when possible
+    return {"isValid": await verify_user_session(request, db) is not None}
 
 
-@app.get("/test")
-def test_endpoint(db: Session = Depends(get_db)):
-    return db.query(User).first()
+@app.get("/ready")
+def ready():
+    # Readiness probe for the load balancer, unready until the workers are warm
+    if not face_pool.ready:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Face workers are warming up.",
+            headers={"Retry-After": str(face_pool.retry_after)},
+        )
+    return {"ready": True, "workers": face_pool.workers}
 
 
-def crop_image_with_padding(image_bytes, padding_percentage=0.2):
-    """
-    Crops an image to include the face with a padding around it.
+@app.get("/metrics")
+def prometheus_metrics():
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
 
-    Args:
-    image_bytes (bytes): The image data in bytes.
-    padding_percentage (float): The percentage of padding relative to the detected face dimensions.
 
-    Returns:
-    Image: The cropped image with padding.
-    """
-    if image_bytes:
-        image = Image.open(BytesIO(image_bytes))
-        if image.mode != "RGB":
-            image = image.convert("RGB")
-        img_array = np.array(image)
-        faces = face_locations(img_array)
-
-        if faces:
-            # Take the first detected face
-            top, right, bottom, left = faces[0]
-
-            # Calculate padding
-            face_height = bottom - top
-            face_width = right - left
-            padding_height = int(face_height * padding_percentage)
-            padding_width = int(face_width * padding_percentage)
-
-            # Apply padding
-            padded_top = max(0, top - padding_height)
-            padded_bottom = min(img_array.shape[0], bottom + padding_height)
-            padded_left = max(0, left - padding_width)
-            padded_right = min(img_array.shape[1], right + padding_width)
-
-            # Crop the image with padding
-            face_image = image.crop(
-                (padded_left, padded_top, padded_right, padded_bottom)
-            )
-            return face_image
+@app.get("/session-cache/stats")
+def session_cache_stats():
+    return session_cache.stats()
 
-        else:
-            raise ValueError("No faces detected in the image.")
-    else:
-        raise ValueError("Invalid image bytes.")
+
+@app.get("/encoding-cache/stats")
+def encoding_cache_stats():
+    return encoding_cache.stats()
+
+
+@app.get("/test")
+def test_endpoint(db: Session = Depends(get_db)):
+    return db.query(User).first()
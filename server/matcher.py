@@ -0,0 +1,122 @@
+"""
+Vectorized face matcher.
+
+A user's stored encodings are kept as one contiguous float32 (K x 128) matrix
+so a login scores every detected face against every template in a single
+NumPy call instead of rebuilding arrays from JSON lists and looping.
+"""
+from collections import OrderedDict
+from dataclasses import dataclass
+
+import numpy as np
+
+from templates import ENCODING_SIZE, unpack_templates
+
+
+@dataclass
+class MatchResult:
+    is_match: bool
+    # distances[i, j] is the distance between detected face i and template j
+    distances: np.ndarray
+    # Templates within tolerance for each detected face
+    match_counts: np.ndarray
+
+
+def as_template_matrix(encodings) -> np.ndarray:
+    return np.ascontiguousarray(
+        np.asarray(encodings, dtype=np.float32).reshape(-1, ENCODING_SIZE)
+    )
+
+
+def face_distances(probes: np.ndarray, templates: np.ndarray) -> np.ndarray:
+    # Euclidean distance, like face_recognition.face_distance, for all pairs
+    return np.linalg.norm(probes[:, None, :] - templates[None, :, :], axis=2)
+
+
+class FaceMatcher:
+    def __init__(self, tolerance=0.4, required_matches=3, cache_size=1024):
+        self.tolerance = tolerance
+        self.required_matches = required_matches
+        self.cache_size = cache_size
+        self.hits = 0
+        self.misses = 0
+        self._templates = OrderedDict()
+
+    def templates_for(self, user) -> np.ndarray:
+        # Materialize the user's templates once and reuse them across logins
+        templates = self.cached(user.id)
+        if templates is None:
+            templates = self.store(user.id, unpack_templates(user.face_templates))
+        return templates
+
+    def cached(self, user_id):
+        templates = self._templates.get(user_id)
+        if templates is not None:
+            self._templates.move_to_end(user_id)
+            self.hits += 1
+        else:
+            self.misses += 1
+        return templates
+
+    def store(self, user_id, templates) -> np.ndarray:
+        templates = as_template_matrix(templates)
+        self._templates[user_id] = templates
+        if len(self._templates) > self.cache_size:
+            self._templates.popitem(last=False)
+        return templates
+
+    def invalidate(self, user_id):
+        self._templates.pop(user_id, None)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._templates),
+            "max_entries": self.cache_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+    def match(self, templates: np.ndarray, probes) -> MatchResult:
+        probes = as_template_matrix(probes)
+        distances = face_distances(probes, templates)
+        match_counts = np.count_nonzero(distances <= self.tolerance, axis=1)
+        is_match = bool(np.any(match_counts >= self.required_matches))
+        return MatchResult(is_match, distances, match_counts)
+
+
+def check_enrollment(encodings, duplicate_distance=0.06, consistency_distance=0.6):
+    """
+    Problems with a set of enrollment encodings, as (message, image indexes).
+
+    Near-identical frames add nothing to the template set, and an image far
+    from the others usually means a different person or a bad capture.
+    """
+    templates = as_template_matrix(encodings)
+    distances = face_distances(templates, templates)
+    issues = []
+
+    first, second = np.triu_indices(len(templates), k=1)
+    for i, j in zip(first, second):
+        if distances[i, j] < duplicate_distance:
+            issues.append(
+                ("Images {} and {} are nearly identical.".format(i + 1, j + 1), (int(i), int(j)))
+            )
+
+    if len(templates) > 2:
+        # Median distance to the other images, ignoring the zero diagonal
+        others = np.sort(distances, axis=1)[:, 1:]
+        for i in np.flatnonzero(np.median(others, axis=1) > consistency_distance):
+            issues.append(
+                ("Image {} does not match the other images.".format(i + 1), (int(i),))
+            )
+    return issues
+
+
+def verify_face_encoding(
+    user_encodings, incoming_encoding, tolerance=0.4, required_matches=3
+):
+    # Single face against a single user's encodings
+    matcher = FaceMatcher(tolerance, required_matches)
+    return matcher.match(as_template_matrix(user_encodings), incoming_encoding).is_match
@@ -0,0 +1,209 @@
+"""
+Prometheus metrics, served on /metrics.
+
+- ``request_stage_seconds{endpoint, stage}``: time spent in each stage of a
+  request: base64 decode, the pipeline stages recorded by the face workers
+  (decode, downscale, detect, crop, landmark, encode), match, db and
+  session creation, plus ``total`` for the whole request
+- ``request_outcomes_total{endpoint, outcome}``: success, no_face,
+  unauthorized (401), not_found (404), busy (503) or the status code
+- ``db_query_seconds{query}``: database round-trips outside the face
+  endpoints, e.g. session lookups behind /validate-token and /user-data
+- ``encode_batch_size``: chips per encoder job when micro-batching is on
+- ``quality_rejections_total{reason}``, ``quality_check_seconds`` and
+  ``quality_saved_seconds_total``: the quality gate, with the worker time it
+  saved estimated from the moving average cost of an analysis
+- face pool depth and cache hit/miss counters, read when scraped
+
+Endpoints add stage timings (in milliseconds, like FaceAnalysis.timings) to
+``request.state.timings`` and may name their outcome in
+``request.state.outcome``; MetricsMiddleware records both once the response
+has started. With several server processes every process keeps its own
+counters, scrape each of them.
+"""
+import time
+from contextlib import contextmanager
+
+from prometheus_client import REGISTRY, Counter, Histogram
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+# Stages range from sub-millisecond (match, cached lookups) to seconds
+# (HOG detection on a large image at high upsampling)
+BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)
+
+OUTCOMES = {
+    401: "unauthorized",
+    404: "not_found",
+    429: "rate_limited",
+    503: "busy",
+}
+
+request_stage_seconds = Histogram(
+    "request_stage_seconds",
+    "Time spent in each stage of a request.",
+    ["endpoint", "stage"],
+    buckets=BUCKETS,
+)
+request_outcomes = Counter(
+    "request_outcomes_total",
+    "Requests by endpoint and outcome.",
+    ["endpoint", "outcome"],
+)
+encode_batch_size = Histogram(
+    "encode_batch_size",
+    "Face chips per batched encoder job.",
+    buckets=(1, 2, 4, 8, 16, 32, 64),
+)
+db_query_seconds = Histogram(
+    "db_query_seconds",
+    "Database round-trips by query.",
+    ["query"],
+    buckets=BUCKETS,
+)
+
+
+quality_rejections = Counter(
+    "quality_rejections_total",
+    "Frames rejected by the quality gate.",
+    ["reason"],
+)
+quality_saved_seconds = Counter(
+    "quality_saved_seconds_total",
+    "Estimated face worker time not spent on frames the quality gate rejected.",
+)
+quality_check_seconds = Histogram(
+    "quality_check_seconds",
+    "Time spent in the quality gate.",
+    buckets=BUCKETS,
+)
+rate_limited = Counter(
+    "rate_limited_total",
+    "Face requests refused with a 429, by the limit they hit.",
+    ["limit"],
+)
+
+
+class CostEstimate:
+    # Moving average of what one image costs in the face workers
+    def __init__(self, weight=0.05):
+        self.weight = weight
+        self.seconds = None
+
+    def observe(self, seconds: float):
+        if self.seconds is None:
+            self.seconds = seconds
+        else:
+            self.seconds += self.weight * (seconds - self.seconds)
+
+
+pipeline_cost = CostEstimate()
+
+
+def record_rejection(reason: str):
+    quality_rejections.labels(reason).inc()
+    if pipeline_cost.seconds:
+        quality_saved_seconds.inc(pipeline_cost.seconds)
+
+
+def observe_timings(endpoint: str, timings: dict):
+    for stage, duration in timings.items():
+        request_stage_seconds.labels(endpoint, stage).observe(duration / 1000)
+
+
+def outcome_for(status_code: int) -> str:
+    if 200 <= status_code < 300:
+        return "success"
+    return OUTCOMES.get(status_code, str(status_code))
+
+
+@contextmanager
+def db_query(query: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        db_query_seconds.labels(query).observe(time.perf_counter() - start)
+
+
+class MetricsMiddleware:
+    # Plain ASGI rather than BaseHTTPMiddleware, which would put every
+    # request body and response through an extra task and stream
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        state = scope.setdefault("state", {})
+        state["timings"] = {}
+        status_code = 500
+        start = time.perf_counter()
+
+        async def send_with_status(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            # The router stores the matched endpoint in the scope, unmatched
+            # paths are not recorded so scanners cannot blow up the labels
+            endpoint = scope.get("endpoint")
+            if endpoint is not None:
+                name = endpoint.__name__
+                timings = state["timings"]
+                timings["total"] = (time.perf_counter() - start) * 1000
+                observe_timings(name, timings)
+                outcome = state.get("outcome") or outcome_for(status_code)
+                request_outcomes.labels(name, outcome).inc()
+
+
+class RuntimeCollector:
+    """
+    Face pool and cache state, read from the live objects on every scrape.
+    """
+
+    def __init__(self, face_pool, caches):
+        self.face_pool = face_pool
+        # name -> object with stats() returning hits, misses, entries and
+        # optionally memory_bytes
+        self.caches = caches
+
+    def collect(self):
+        pool = self.face_pool
+        for name, value, documentation in (
+            ("face_pool_workers", pool.workers, "Face worker processes."),
+            ("face_pool_in_flight", pool.in_flight, "Face jobs running or queued."),
+            ("face_pool_queue_depth", pool.queue_depth, "Face jobs waiting for a worker."),
+            ("face_pool_capacity", pool.capacity, "Face jobs accepted before 503s."),
+            ("face_pool_ready", int(pool.ready), "1 once the workers are warmed up."),
+        ):
+            yield GaugeMetricFamily(name, documentation, value=value)
+
+        hits = CounterMetricFamily("cache_hits", "Cache hits.", labels=["cache"])
+        misses = CounterMetricFamily("cache_misses", "Cache misses.", labels=["cache"])
+        entries = GaugeMetricFamily("cache_entries", "Cached entries.", labels=["cache"])
+        memory = GaugeMetricFamily(
+            "cache_memory_bytes", "Approximate memory held by a cache.", labels=["cache"]
+        )
+        for name, cache in self.caches.items():
+            stats = cache.stats()
+            hits.add_metric([name], stats["hits"])
+            misses.add_metric([name], stats["misses"])
+            entries.add_metric([name], stats["entries"])
+            if "memory_bytes" in stats:
+                memory.add_metric([name], stats["memory_bytes"])
+        yield hits
+        yield misses
+        yield entries
+        yield memory
+
+
+def register_runtime(face_pool, caches):
+    REGISTRY.register(RuntimeCollector(face_pool, caches))
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, ForeignKey, Integer, String, DateTime
+from sqlalchemy import Column, ForeignKey, Integer, String, DateTime, Index
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 from config import Base
@@ -16,4 +16,11 @@ class Session(Base):
     )
     expiration = Column(DateTime, nullable=False)
 
-    user = relationship("User", back_populates="sessions") 
+    user = relationship("User", back_populates="sessions")
+
+    __table_args__ = (
+        # Token lookups filter on expiration too, the reaper on expiration alone
+        Index("ix_sessions_token_expiration", "session_token", "expiration"),
+        Index("ix_sessions_user_id", "user_id"),
+        Index("ix_sessions_expiration", "expiration"),
+    ) 
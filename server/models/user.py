@@ -1,14 +1,23 @@
-from sqlalchemy import Column, Integer, String, JSON
-from sqlalchemy.orm import relationship
+from sqlalchemy import Column, Integer, String, LargeBinary
+from sqlalchemy.orm import relationship, deferred, validates
 from config import Base
 
 
+def normalize_key(value):
+    # Lookup form of student_id / matriculation_number, logins are case-insensitive
+    return value.lower() if value is not None else None
+
+
 class User(Base):
     __tablename__ = "users"
 
     id = Column(Integer, primary_key=True)
     student_id = Column(String, unique=True)
     matriculation_number = Column(String, unique=True)
+    # Normalized copies kept in sync by _set_lookup_key, so lookups can use
+    # a plain indexed equality instead of lower(column)
+    student_id_key = Column(String, unique=True, index=True)
+    matriculation_number_key = Column(String, unique=True, index=True)
     firstname = Column(String)
     middlename = Column(String, nullable=True)
     lastname = Column(String)
@@ -23,5 +32,12 @@ class User(Base):
 
     sessions = relationship("Session", back_populates="user")
 
-    face_encodings = Column(JSON)
+    # Packed float32/float16 matrix, see templates.py. Deferred: only loaded
+    # when the matcher needs this user's templates
+    face_templates = deferred(Column(LargeBinary))
+
+    @validates("student_id", "matriculation_number")
+    def _set_lookup_key(self, key, value):
+        setattr(self, f"{key}_key", normalize_key(value))
+        return value
     
\ No newline at end of file
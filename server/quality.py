@@ -0,0 +1,116 @@
+"""
+Cheap image-quality gate run before a frame is sent to the face workers.
+
+Blurry, dark or tiny frames used to go through detection and encoding only
+to come back as "No faces detected" or a failed match. QualityGate looks at
+a small grayscale copy (JPEGs are decoded at reduced scale straight from
+libjpeg) and rejects a frame when:
+
+- image_too_small: the shorter side is below ``min_side``
+- image_too_dark / image_overexposed: the mean brightness is outside
+  ``min_brightness``..``max_brightness`` or more than ``max_clipped`` of the
+  pixels are crushed to black or blown out to white
+- image_too_blurry: the variance of the Laplacian, measured at
+  ``analysis_side`` pixels, is below ``min_sharpness``
+
+The checks run in that order and the first failure is the reason. A check
+costs a few milliseconds, against the hundreds the dlib stages take.
+"""
+from dataclasses import dataclass
+from io import BytesIO
+from typing import Optional
+
+import numpy as np
+from PIL import Image
+
+MESSAGES = {
+    "image_too_small": "The image is too small. Move closer to the camera or use a higher resolution.",
+    "image_too_dark": "The image is too dark. Find better lighting and retry.",
+    "image_overexposed": "The image is overexposed. Avoid bright light behind or on the camera.",
+    "image_too_blurry": "The image is too blurry. Hold still and retry.",
+}
+
+
+class ImageRejected(Exception):
+    def __init__(self, reason: str, image: Optional[int] = None):
+        # image is the 1-based position when a request carries several
+        message = MESSAGES[reason]
+        if image is not None:
+            message = f"Image {image}: {message}"
+        super().__init__(message)
+        self.reason = reason
+        self.message = message
+
+
+@dataclass(frozen=True)
+class QualityReport:
+    width: int
+    height: int
+    brightness: float
+    clipped: float
+    sharpness: float
+    reason: Optional[str] = None
+
+
+def laplacian_variance(gray: np.ndarray) -> float:
+    # 4-neighbour Laplacian on the interior pixels, no padding or copies
+    laplacian = (
+        gray[:-2, 1:-1] + gray[2:, 1:-1] + gray[1:-1, :-2] + gray[1:-1, 2:]
+        - 4 * gray[1:-1, 1:-1]
+    )
+    return float(laplacian.var())
+
+
+class QualityGate:
+    def __init__(
+        self,
+        min_side=160,
+        min_brightness=40.0,
+        max_brightness=215.0,
+        max_clipped=0.4,
+        min_sharpness=20.0,
+        analysis_side=256,
+    ):
+        self.min_side = min_side
+        self.min_brightness = min_brightness
+        self.max_brightness = max_brightness
+        self.max_clipped = max_clipped
+        self.min_sharpness = min_sharpness
+        self.analysis_side = analysis_side
+
+    def measure(self, image_bytes: bytes) -> QualityReport:
+        image = Image.open(BytesIO(image_bytes))
+        width, height = image.size
+        side = self.analysis_side
+        image.draft("L", (side, side))
+        gray = image.convert("L")
+        gray.thumbnail((side, side), Image.BILINEAR)
+        pixels = np.asarray(gray, dtype=np.float32)
+
+        histogram = np.bincount(np.asarray(gray).ravel(), minlength=256)
+        total = histogram.sum()
+        dark = histogram[:16].sum() / total
+        bright = histogram[240:].sum() / total
+        brightness = float(pixels.mean())
+
+        if min(width, height) < self.min_side:
+            reason = "image_too_small"
+        elif brightness < self.min_brightness or dark > self.max_clipped:
+            reason = "image_too_dark"
+        elif brightness > self.max_brightness or bright > self.max_clipped:
+            reason = "image_overexposed"
+        else:
+            reason = None
+
+        # Only worth the Laplacian when nothing else failed already
+        sharpness = laplacian_variance(pixels) if reason is None else 0.0
+        if reason is None and sharpness < self.min_sharpness:
+            reason = "image_too_blurry"
+        return QualityReport(width, height, brightness, float(max(dark, bright)), sharpness, reason)
+
+    def check(self, image_bytes: bytes, image: Optional[int] = None) -> QualityReport:
+        # Raises ImageRejected with the reason code of the first failed check
+        report = self.measure(image_bytes)
+        if report.reason:
+            raise ImageRejected(report.reason, image)
+        return report
@@ -0,0 +1,169 @@
+"""
+Admission control for the face endpoints.
+
+Every face request costs hundreds of milliseconds of worker CPU, so they are
+limited before any image is decoded:
+
+- a token bucket per client IP, checked before the body is read
+- a token bucket per student_id, checked as soon as the form fields are
+  parsed (see read_face_upload's ``admit``)
+- a cap on face requests in progress in this process
+
+Anything over a limit gets a 429 with a Retry-After header.
+
+Buckets live in a backend. MemoryBackend keeps them in this process, which
+is enough for a single server process and for tests. RedisBackend keeps them
+in Redis (or anything speaking its protocol and EVAL) so the limits hold
+across server processes; it needs the ``redis`` package. The concurrency cap
+is always per process, like the face pool it protects.
+"""
+import math
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import Tuple
+
+from fastapi import HTTPException, status
+
+import metrics
+from models.user import normalize_key
+
+
+class MemoryBackend:
+    def __init__(self, max_keys=100000):
+        self.max_keys = max_keys
+        # key -> [tokens, last refill], least recently used first
+        self._buckets = OrderedDict()
+
+    async def take(self, key: str, capacity: float, rate: float) -> Tuple[bool, float]:
+        # (allowed, seconds until a token is available)
+        now = time.monotonic()
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = [capacity, now]
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+            bucket[0] = min(capacity, bucket[0] + (now - bucket[1]) * rate)
+            bucket[1] = now
+        if bucket[0] >= 1:
+            bucket[0] -= 1
+            return True, 0.0
+        return False, (1 - bucket[0]) / rate
+
+
+# Refill and take in one atomic step, with the Redis server's clock so every
+# process sees the same time
+TOKEN_BUCKET_SCRIPT = """
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local clock = redis.call("TIME")
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local state = redis.call("HMGET", KEYS[1], "tokens", "updated")
+local tokens = tonumber(state[1]) or capacity
+local updated = tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - updated) * rate)
+local allowed = 0
+local wait = 0
+if tokens >= 1 then
+  tokens = tokens - 1
+  allowed = 1
+else
+  wait = (1 - tokens) / rate
+end
+redis.call("HSET", KEYS[1], "tokens", tostring(tokens), "updated", tostring(now))
+redis.call("EXPIRE", KEYS[1], math.ceil(capacity / rate) + 1)
+return {allowed, tostring(wait)}
+"""
+
+
+class RedisBackend:
+    def __init__(self, url: str, prefix="ratelimit:"):
+        import redis.asyncio as redis
+
+        self.prefix = prefix
+        self._client = redis.from_url(url)
+        self._script = self._client.register_script(TOKEN_BUCKET_SCRIPT)
+
+    async def take(self, key: str, capacity: float, rate: float) -> Tuple[bool, float]:
+        allowed, wait = await self._script(keys=[self.prefix + key], args=[capacity, rate])
+        return bool(allowed), float(wait)
+
+
+def too_many_requests(limit: str, retry_after: float) -> HTTPException:
+    metrics.rate_limited.labels(limit).inc()
+    return HTTPException(
+        status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+        detail="Too many attempts. Wait a moment and retry.",
+        headers={"Retry-After": str(max(1, math.ceil(retry_after)))},
+    )
+
+
+class RateLimiter:
+    def __init__(
+        self,
+        backend,
+        ip_rate: float,
+        ip_burst: float,
+        identity_rate: float,
+        identity_burst: float,
+        max_concurrent: int,
+        trusted_proxies: int = 0,
+    ):
+        self.backend = backend
+        # Rates in requests per second, bursts in requests
+        self.ip_rate = ip_rate
+        self.ip_burst = ip_burst
+        self.identity_rate = identity_rate
+        self.identity_burst = identity_burst
+        self.max_concurrent = max_concurrent
+        # Reverse proxies in front of the server that append to X-Forwarded-For
+        self.trusted_proxies = trusted_proxies
+        # Only the event loop thread touches in_progress, so no lock is needed
+        self.in_progress = 0
+        self._warned_proxy = False
+
+    def client_ip(self, connection) -> str:
+        # Request or WebSocket
+        forwarded = connection.headers.get("x-forwarded-for")
+        if forwarded and self.trusted_proxies:
+            # Entries to the left of the ones our proxies appended come from
+            # the client and can be anything
+            addresses = [address.strip() for address in forwarded.split(",")]
+            return addresses[-min(self.trusted_proxies, len(addresses))]
+        if forwarded and not self._warned_proxy:
+            self._warned_proxy = True
+            print(
+                "Warning: requests carry X-Forwarded-For but RATE_LIMIT_TRUST_PROXY "
+                "is off, every client behind the proxy shares one per-IP rate limit"
+            )
+        return connection.client.host if connection.client else "unknown"
+
+    async def check_ip(self, connection):
+        allowed, wait = await self.backend.take(
+            f"ip:{self.client_ip(connection)}", self.ip_burst, self.ip_rate
+        )
+        if not allowed:
+            raise too_many_requests("ip", wait)
+
+    async def check_identity(self, student_id: str):
+        allowed, wait = await self.backend.take(
+            f"student:{normalize_key(student_id)}", self.identity_burst, self.identity_rate
+        )
+        if not allowed:
+            raise too_many_requests("identity", wait)
+
+    async def check_form(self, form):
+        # read_face_upload's admit hook, runs before any image is decoded
+        await self.check_identity(form.student_id)
+
+    @asynccontextmanager
+    async def face_slot(self):
+        if self.in_progress >= self.max_concurrent:
+            raise too_many_requests("concurrency", 1)
+        self.in_progress += 1
+        try:
+            yield
+        finally:
+            self.in_progress -= 1
@@ -0,0 +1,50 @@
+"""
+Request bodies and form fields of the face endpoints.
+
+Kept apart from main.py so tools like bulk_enroll can validate the same
+fields without importing the app.
+"""
+from typing import List
+
+from pydantic import BaseModel, Field
+
+
+class LoginForm(BaseModel):
+    # username: str
+    student_id: str
+    matriculation_number: str
+
+
+class LoginRequest(LoginForm):
+    face_encoding: str
+
+
+class IdentifyRequest(BaseModel):
+    face_encoding: str
+    top_k: int = Field(default=5, ge=1, le=20)
+
+
+class TokenRequest(BaseModel):
+    token: str
+
+
+class RegisterForm(BaseModel):
+    # username: str
+    # fullname: str
+    # bio: str
+    student_id: str
+    matriculation_number: str
+    firstname: str
+    middlename: str
+    lastname: str
+    date_of_birth: str
+    email: str
+    phone_number: str
+    faculty: str
+    department: str
+    level: str
+    academic_session: str
+
+
+class RegisterRequest(RegisterForm):
+    face_encodings: List[str]
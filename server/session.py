@@ -1,68 +1,204 @@
-from fastapi import Depends, HTTPException, status, WebSocket, Request
+from fastapi import Depends, HTTPException, status, Request
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session as SQLSession
 from models.session import Session
-from config import SessionLocal
+from config import (
+    SessionLocal,
+    get_async_db,
+    SESSION_CACHE_SIZE,
+    SESSION_CACHE_TTL,
+    SESSION_CACHE_REVALIDATE,
+    SESSION_MODE,
+    SESSION_SIGNING_KEYS,
+    SESSION_SIGNING_KEY_ID,
+    SESSION_DENYLIST_PATH,
+    SESSION_DENYLIST_FLUSH_INTERVAL,
+    SESSION_REAP_INTERVAL,
+    SESSION_REAP_BATCH,
+    MAX_SESSIONS_PER_USER,
+)
 from models.user import User
+from session_cache import CurrentUser, PROJECTION_COLUMNS, SessionCache
+from signed_tokens import Denylist, TokenSigner, parse_keys
+import metrics
+import asyncio
 import secrets
 from typing import Optional
 from datetime import datetime, timedelta
 
 
+session_cache = SessionCache(
+    max_entries=SESSION_CACHE_SIZE,
+    ttl=SESSION_CACHE_TTL,
+    # Signed tokens have no row, revocations reach them through the denylist
+    revalidate=SESSION_CACHE_REVALIDATE if SESSION_MODE == "database" else None,
+)
+
+# Only set when SESSION_MODE=signed
+signer = None
+denylist = Denylist(SESSION_DENYLIST_PATH)
+
+if SESSION_MODE == "signed":
+    signing_keys = parse_keys(SESSION_SIGNING_KEYS)
+    if not signing_keys:
+        raise RuntimeError("SESSION_SIGNING_KEYS must be set when SESSION_MODE=signed.")
+    signer = TokenSigner(signing_keys, SESSION_SIGNING_KEY_ID or next(iter(signing_keys)))
+elif SESSION_MODE != "database":
+    raise RuntimeError(f"Unknown SESSION_MODE {SESSION_MODE!r}.")
+
+
 def create_session_token() -> str:
     return secrets.token_urlsafe()
 
 
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
+def create_user_session(user: User, db: SQLSession, session_duration: int = 60*60):
+    if signer:
+        # Stateless token, nothing to store
+        return signer.issue(user.id, session_duration)
 
+    with metrics.db_query("session_create"):
+        # Create a session token and store it in the database
+        session_token = create_session_token()
+        expiration_time = datetime.utcnow() + timedelta(seconds=session_duration)
+        new_session = Session(
+            user_id=user.id, session_token=session_token, expiration=expiration_time
+        )
+        db.add(new_session)
+        db.flush()
 
-def create_user_session(user: User, db: SQLSession, session_duration: int = 60*60):
-    # Create a session token and store it in the database
-    session_token = create_session_token()
-    expiration_time = datetime.utcnow() + timedelta(seconds=session_duration)
-    new_session = Session(
-        user_id=user.id, session_token=session_token, expiration=expiration_time
-    )
-    db.add(new_session)
-    db.commit()
+        # End the oldest sessions once the user has more than the cap
+        surplus = (
+            db.query(Session.id, Session.session_token)
+            .filter(Session.user_id == user.id)
+            .order_by(Session.expiration.desc(), Session.id.desc())
+            .offset(MAX_SESSIONS_PER_USER)
+            .all()
+        )
+        if surplus:
+            db.query(Session).filter(
+                Session.id.in_([session_id for session_id, _ in surplus])
+            ).delete(synchronize_session=False)
+            for _, token in surplus:
+                session_cache.invalidate(token)
+
+        db.commit()
     return session_token
 
 
-def verify_user_session(request: Request, db: SQLSession) -> Optional[User]:
+async def verify_user_session(request: Request, db: AsyncSession) -> Optional[CurrentUser]:
     # Extract session token from cookies
     session_token = request.cookies.get("session_token")
     if not session_token:
         return None
+    return await resolve_session_async(session_token, db)
 
-    try:
-        session = (
-            db.query(Session)
-            .filter(
+
+def begin_session_lookup(session_token: str):
+    """
+    Everything in a session lookup that doesn't need the database.
+
+    Returns (current_user, statement, claims). When statement is None the
+    lookup is already decided and current_user is the answer, otherwise run
+    statement and pass its first row, with the rest of the tuple, to
+    finish_session_lookup. A current_user with a statement is a stale cache
+    entry whose session row is being checked again.
+    """
+    claims = None
+    if signer:
+        # Signature, expiry and revocation are all checked without the database
+        claims = signer.verify(session_token)
+        if not claims or denylist.is_revoked(claims):
+            return None, None, None
+
+    current_user, stale = session_cache.get(session_token)
+    if current_user and not stale:
+        return current_user, None, None
+    if current_user:
+        # Another process may have ended the session since it was cached,
+        # the index on (session_token, expiration) answers this on its own
+        statement = select(Session.expiration).where(
+            Session.session_token == session_token,
+            Session.expiration > datetime.utcnow(),
+        )
+        return current_user, statement, None
+
+    if signer:
+        # Only the user projection is loaded, then cached with the token
+        statement = select(*PROJECTION_COLUMNS).where(User.id == claims.user_id)
+    else:
+        # Session and user in one query, only the columns the endpoints use
+        statement = (
+            select(Session.expiration, *PROJECTION_COLUMNS)
+            .join(User, User.id == Session.user_id)
+            .where(
                 Session.session_token == session_token,
                 Session.expiration
                 > datetime.utcnow(),  # Assuming expiration is a datetime
             )
-            .first()
         )
+    return None, statement, claims
+
 
-        if session:
-            return db.query(User).filter(User.id == session.user_id).first()
+def finish_session_lookup(
+    session_token: str, row, claims, current_user: Optional[CurrentUser] = None
+) -> Optional[CurrentUser]:
+    if row is None:
+        session_cache.invalidate(session_token)
         return None
+    if current_user:
+        session_cache.put(session_token, current_user, row[0])
+        return current_user
+    if claims:
+        expiration = datetime.utcfromtimestamp(claims.expires_at)
+        fields = row
+    else:
+        expiration, *fields = row
+    current_user = CurrentUser(*fields)
+    session_cache.put(session_token, current_user, expiration)
+    return current_user
+
+
+def resolve_session(session_token: str, db: SQLSession) -> Optional[CurrentUser]:
+    current_user, statement, claims = begin_session_lookup(session_token)
+    if statement is None:
+        return current_user
+    try:
+        with metrics.db_query("session_lookup"):
+            row = db.execute(statement).first()
     except Exception as e:
         # Handle or log the exception as appropriate
         print(f"Error verifying user session: {str(e)}")
         return None
+    return finish_session_lookup(session_token, row, claims, current_user)
+
+
+async def resolve_session_async(session_token: str, db: AsyncSession) -> Optional[CurrentUser]:
+    current_user, statement, claims = begin_session_lookup(session_token)
+    if statement is None:
+        return current_user
+    try:
+        with metrics.db_query("session_lookup"):
+            row = (await db.execute(statement)).first()
+    except Exception as e:
+        # Handle or log the exception as appropriate
+        print(f"Error verifying user session: {str(e)}")
+        return None
+    return finish_session_lookup(session_token, row, claims, current_user)
 
 
 def invalidate_user_session(request: Request, db: SQLSession) -> bool:
     try:
         # Assuming the session token is stored in a cookie
         session_token = request.cookies.get("session_token")
+        if session_token and signer:
+            claims = signer.verify(session_token)
+            if claims:
+                denylist.revoke(claims)
+            session_cache.invalidate(session_token)
+            return True
         if session_token:
+            session_cache.invalidate(session_token)
             db.query(Session).filter(Session.session_token == session_token).delete()
             db.commit()
             return True
@@ -72,11 +208,60 @@ def invalidate_user_session(request: Request, db: SQLSession) -> bool:
         return False
 
 
-def get_current_user(request: Request, db: SQLSession = Depends(get_db)) -> User:
+async def get_current_user(
+    request: Request, db: AsyncSession = Depends(get_async_db)
+) -> CurrentUser:
     # Verify the session and retrieve the user associated with it
-    user = verify_user_session(request, db)
+    user = await verify_user_session(request, db)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED, detail="Not authenticated"
         )
     return user
+
+
+async def flush_denylist_periodically():
+    # Share revoked signed tokens with the other server processes and persist
+    # them so a restart doesn't bring them back
+    while True:
+        await asyncio.sleep(SESSION_DENYLIST_FLUSH_INTERVAL)
+        try:
+            await asyncio.to_thread(denylist.sync)
+        except Exception as e:
+            print(f"Error syncing the session denylist: {e}")
+
+
+def reap_expired_sessions(batch_size: int = SESSION_REAP_BATCH) -> int:
+    # Delete expired sessions in bounded batches so no transaction holds the
+    # write lock for long
+    db = SessionLocal()
+    reaped = 0
+    try:
+        while True:
+            expired = [
+                session_id
+                for (session_id,) in db.query(Session.id)
+                .filter(Session.expiration <= datetime.utcnow())
+                .limit(batch_size)
+            ]
+            if not expired:
+                return reaped
+            db.query(Session).filter(Session.id.in_(expired)).delete(
+                synchronize_session=False
+            )
+            db.commit()
+            reaped += len(expired)
+            if len(expired) < batch_size:
+                return reaped
+    finally:
+        db.close()
+
+
+async def reap_expired_sessions_periodically():
+    while True:
+        try:
+            with metrics.db_query("session_reap"):
+                await asyncio.to_thread(reap_expired_sessions)
+        except Exception as e:
+            print(f"Error reaping expired sessions: {str(e)}")
+        await asyncio.sleep(SESSION_REAP_INTERVAL)
@@ -0,0 +1,115 @@
+"""
+In-process cache of verified sessions.
+
+Every authenticated request used to read the session row and then the user
+row. Verified sessions are cached here, keyed by a SHA-256 of the token so
+raw tokens are never held in memory, together with the projection of the
+user that the endpoints need. Entries expire after ``ttl`` seconds or at
+the session's own expiration, whichever comes first, and the least recently
+used entries are evicted once ``max_entries`` is reached.
+
+Other server processes can end a session (logout, the per-user cap) without
+this cache hearing about it. With ``revalidate`` set, an entry verified more
+than that many seconds ago is returned as stale, and the caller checks the
+session row again before trusting it.
+"""
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Optional, Tuple
+
+from models.user import User
+
+
+@dataclass(frozen=True)
+class CurrentUser:
+    id: int
+    student_id: str
+    firstname: str
+    middlename: Optional[str]
+    lastname: str
+    date_of_birth: str
+    email: str
+    phone_number: str
+    faculty: str
+    department: str
+    level: str
+    academic_session: str
+    passport: Optional[str]
+
+
+# The User columns the projection is loaded from, in CurrentUser order
+PROJECTION_COLUMNS = [
+    getattr(User, name) for name in CurrentUser.__dataclass_fields__
+]
+
+
+def token_key(session_token: str) -> str:
+    return hashlib.sha256(session_token.encode()).hexdigest()
+
+
+class SessionCache:
+    def __init__(self, max_entries=10000, ttl=60, revalidate=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.revalidate = revalidate
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        # Also reached from sync endpoints running in the threadpool
+        self._lock = threading.Lock()
+
+    def get(self, session_token: str) -> Tuple[Optional[CurrentUser], bool]:
+        # (user, whether the session must be checked again before use)
+        key = token_key(session_token)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                stale = self.revalidate is not None and now - entry[2] >= self.revalidate
+                return entry[1], stale
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None, False
+
+    def put(self, session_token: str, user: CurrentUser, expiration: datetime):
+        # Also called after a successful recheck, which restarts the window
+        now = time.monotonic()
+        remaining = (expiration - datetime.utcnow()).total_seconds()
+        key = token_key(session_token)
+        with self._lock:
+            entry = self._entries.get(key)
+            # A recheck doesn't extend the ttl
+            expires_at = entry[0] if entry else now + min(self.ttl, remaining)
+            self._entries[key] = (min(expires_at, now + remaining), user, now)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, session_token: str):
+        with self._lock:
+            self._entries.pop(token_key(session_token), None)
+
+    def invalidate_user(self, user_id: int):
+        with self._lock:
+            for key in [
+                key for key, (_, user, _) in self._entries.items() if user.id == user_id
+            ]:
+                del self._entries[key]
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
@@ -0,0 +1,170 @@
+"""
+Stateless, HMAC-signed session tokens (SESSION_MODE=signed).
+
+A token carries the user id, its expiry, the id of the key that signed it
+and a random token id:
+
+    v1.<base64url(json claims)>.<base64url(HMAC-SHA256 signature)>
+
+Verifying one needs no database round-trip. Keys are configured as
+``kid:secret`` pairs; new tokens are signed with the active key while every
+configured key is still accepted, so rotating to a new key keeps sessions
+signed with the previous one valid until they expire. Retire an old key
+only after the session duration has passed.
+
+Logout cannot delete a signed token, so revoked token ids go on a
+denylist kept in memory until the token would have expired anyway. Each
+server process keeps its own copy and periodically syncs it with the shared
+file: under an flock the file is read, merged with the revocations made in
+this process and written back. A logout handled by one process reaches the
+others within one sync interval, and survives restarts. Without fcntl
+(Windows) there is no locking, run a single server process there.
+"""
+import base64
+import hashlib
+import hmac
+import json
+import os
+import secrets
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Dict, Optional
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+VERSION = "v1"
+
+
+@dataclass(frozen=True)
+class TokenClaims:
+    user_id: int
+    expires_at: int
+    key_id: str
+    token_id: str
+
+
+def b64encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
+
+
+def b64decode(data: str) -> bytes:
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+
+def parse_keys(value: str) -> Dict[str, bytes]:
+    # "kid1:secret1,kid2:secret2"
+    keys = {}
+    for pair in filter(None, (item.strip() for item in value.split(","))):
+        key_id, _, secret = pair.partition(":")
+        if not key_id or not secret:
+            raise ValueError(f"Malformed signing key entry: {key_id or pair!r}")
+        keys[key_id] = secret.encode()
+    return keys
+
+
+class TokenSigner:
+    def __init__(self, keys: Dict[str, bytes], active_key_id: str):
+        if active_key_id not in keys:
+            raise ValueError(f"Active signing key {active_key_id!r} is not configured.")
+        self.keys = keys
+        self.active_key_id = active_key_id
+
+    def _sign(self, key_id: str, message: bytes) -> bytes:
+        return hmac.new(self.keys[key_id], message, hashlib.sha256).digest()
+
+    def issue(self, user_id: int, duration: int) -> str:
+        claims = {
+            "uid": user_id,
+            "exp": int(time.time()) + duration,
+            "kid": self.active_key_id,
+            "jti": secrets.token_urlsafe(12),
+        }
+        payload = f"{VERSION}.{b64encode(json.dumps(claims, separators=(',', ':')).encode())}"
+        signature = self._sign(self.active_key_id, payload.encode())
+        return f"{payload}.{b64encode(signature)}"
+
+    def verify(self, token: str) -> Optional[TokenClaims]:
+        try:
+            version, encoded_claims, encoded_signature = token.split(".")
+            if version != VERSION:
+                return None
+            claims = json.loads(b64decode(encoded_claims))
+            key_id = claims["kid"]
+            if key_id not in self.keys:
+                return None
+            expected = self._sign(key_id, f"{version}.{encoded_claims}".encode())
+            if not hmac.compare_digest(expected, b64decode(encoded_signature)):
+                return None
+            if claims["exp"] <= time.time():
+                return None
+            return TokenClaims(int(claims["uid"]), int(claims["exp"]), key_id, claims["jti"])
+        except (ValueError, KeyError, TypeError):
+            return None
+
+
+class Denylist:
+    def __init__(self, path: Optional[str] = None):
+        self.path = path
+        self._entries: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def revoke(self, claims: TokenClaims):
+        with self._lock:
+            self._entries[claims.token_id] = claims.expires_at
+
+    def is_revoked(self, claims: TokenClaims) -> bool:
+        with self._lock:
+            return claims.token_id in self._entries
+
+    def prune(self):
+        # Expired tokens fail verification on their own, forget them
+        now = time.time()
+        with self._lock:
+            expired = [jti for jti, expires_at in self._entries.items() if expires_at <= now]
+            for jti in expired:
+                del self._entries[jti]
+
+    @contextmanager
+    def _file_lock(self):
+        if fcntl is None:
+            yield
+            return
+        with open(f"{self.path}.lock", "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def sync(self):
+        # Merge with the shared file: revocations from other processes are
+        # picked up, and theirs are kept when this process writes its own
+        if not self.path:
+            return
+        with self._file_lock():
+            stored = {}
+            if os.path.exists(self.path):
+                with open(self.path) as denylist_file:
+                    stored = {jti: int(exp) for jti, exp in json.load(denylist_file).items()}
+            with self._lock:
+                for jti, expires_at in stored.items():
+                    self._entries.setdefault(jti, expires_at)
+            self.prune()
+            with self._lock:
+                entries = dict(self._entries)
+            if entries == stored:
+                return
+            # Write then rename so a crash never leaves a truncated file behind
+            temporary_path = f"{self.path}.tmp"
+            with open(temporary_path, "w") as denylist_file:
+                json.dump(entries, denylist_file)
+            os.replace(temporary_path, self.path)
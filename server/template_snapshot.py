@@ -0,0 +1,327 @@
+"""
+Memory-mapped snapshot of every face template, shared by the server processes.
+
+Loading the 1:N index used to read every User.face_templates row in every
+server process, so startup time and memory grew with students x processes.
+The index is now written once to a snapshot file that each process maps
+read-only: FaceIndex searches the arrays in place, the pages are shared
+through the OS page cache and startup costs the same at any population.
+
+    offset  size  field
+    0       4     magic b"FSNP"
+    4       1     format version (1)
+    5       3     reserved
+    8       8     snapshot version
+    16      8     newest user id covered, users without templates included
+    24      8     templates (N)
+    32      8     users (U)
+    40      8     IVF lists (L), 0 when the index is searched by brute force
+    48      16    reserved
+    64      ...   sections, little endian, each starting on a 64-byte boundary:
+                  vectors       N x 128 float32, grouped by IVF list
+                  norms         N float32, squared norm of each vector
+                  owners        N int64, user id of each vector
+                  user_ids      U int64, sorted
+                  user_offsets  U + 1 int64, each user's range of user_rows
+                  user_rows     N int64, vector rows ordered by user
+                  centroids     L x 128 float32
+                  list_offsets  L + 1 int64, each list's range of rows
+
+Snapshot <version> lives in templates-<version>.snap next to its delta log,
+templates-<version>.delta. face_register appends a record (user id, blob
+length, packed templates as in templates.py) to the log of the latest
+snapshot, and every process replays new records on refresh(), so users
+registered through any process become searchable everywhere. Once a log
+holds enough users compact() folds it into the next snapshot, retraining
+the IVF lists, and the processes switch to it on their next refresh.
+
+Appends and publishing a snapshot hold an flock on <dir>/lock, compaction
+holds <dir>/compact.lock. Without fcntl (Windows) there is no locking, run a
+single server process there.
+"""
+import math
+import mmap
+import os
+import re
+import struct
+from contextlib import contextmanager
+from typing import Optional
+
+import numpy as np
+
+from matcher import ENCODING_SIZE
+from templates import unpack_templates
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+MAGIC = b"FSNP"
+VERSION = 1
+HEADER = struct.Struct("<4sB3xqqqqq16x")
+RECORD = struct.Struct("<qI")
+ALIGNMENT = 64
+SNAPSHOT_NAME = re.compile(r"^templates-(\d+)\.snap$")
+
+
+def layout(count: int, users: int, lists: int):
+    # [(name, dtype, shape, offset)] and the file size
+    sections = [
+        ("vectors", "<f4", (count, ENCODING_SIZE)),
+        ("norms", "<f4", (count,)),
+        ("owners", "<i8", (count,)),
+        ("user_ids", "<i8", (users,)),
+        ("user_offsets", "<i8", (users + 1,)),
+        ("user_rows", "<i8", (count,)),
+        ("centroids", "<f4", (lists, ENCODING_SIZE)),
+        ("list_offsets", "<i8", (lists + 1,)),
+    ]
+    result = []
+    offset = HEADER.size
+    for name, dtype, shape in sections:
+        dtype = np.dtype(dtype)
+        result.append((name, dtype, shape, offset))
+        size = dtype.itemsize * math.prod(shape)
+        offset += -(-size // ALIGNMENT) * ALIGNMENT
+    return result, offset
+
+
+class TemplateSnapshot:
+    def __init__(self, path: str):
+        with open(path, "rb") as snapshot_file:
+            # The mapping outlives the file handle, and stays valid after the
+            # file is replaced or removed
+            self._map = mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ)
+        (
+            magic,
+            version,
+            self.version,
+            self.newest_user_id,
+            self.count,
+            users,
+            lists,
+        ) = HEADER.unpack_from(self._map)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"Unrecognized template snapshot: {path}")
+        sections, _ = layout(self.count, users, lists)
+        for name, dtype, shape, offset in sections:
+            array = np.frombuffer(self._map, dtype=dtype, count=math.prod(shape), offset=offset)
+            setattr(self, name, array.reshape(shape))
+
+    def _position(self, user_id) -> Optional[int]:
+        position = int(np.searchsorted(self.user_ids, user_id))
+        if position < len(self.user_ids) and self.user_ids[position] == user_id:
+            return position
+        return None
+
+    def contains(self, user_id) -> bool:
+        return self._position(user_id) is not None
+
+    def templates(self, user_id) -> np.ndarray:
+        position = self._position(user_id)
+        if position is None:
+            return self.vectors[:0]
+        start, end = self.user_offsets[position : position + 2]
+        return self.vectors[self.user_rows[start:end]]
+
+    def users(self):
+        # (user_id, templates) for every user, in id order
+        for position, user_id in enumerate(self.user_ids):
+            start, end = self.user_offsets[position : position + 2]
+            yield int(user_id), self.vectors[self.user_rows[start:end]]
+
+
+def write_snapshot(path: str, version: int, newest_user_id: int, index):
+    # index is a FaceIndex built in memory, see FaceIndex.arrays
+    vectors, norms, owners, centroids, list_offsets = index.arrays()
+    user_rows = np.argsort(owners, kind="stable")
+    user_ids, starts = np.unique(owners[user_rows], return_index=True)
+    user_offsets = np.append(starts, len(owners))
+    arrays = {
+        "vectors": vectors,
+        "norms": norms,
+        "owners": owners,
+        "user_ids": user_ids,
+        "user_offsets": user_offsets,
+        "user_rows": user_rows,
+        "centroids": centroids,
+        "list_offsets": list_offsets,
+    }
+    sections, size = layout(len(owners), len(user_ids), len(centroids))
+    with open(path, "wb") as snapshot_file:
+        snapshot_file.write(
+            HEADER.pack(
+                MAGIC,
+                VERSION,
+                version,
+                newest_user_id,
+                len(owners),
+                len(user_ids),
+                len(centroids),
+            )
+        )
+        for name, dtype, shape, offset in sections:
+            snapshot_file.write(b"\0" * (offset - snapshot_file.tell()))
+            snapshot_file.write(np.ascontiguousarray(arrays[name], dtype=dtype).reshape(shape).data)
+        snapshot_file.write(b"\0" * (size - snapshot_file.tell()))
+        snapshot_file.flush()
+        os.fsync(snapshot_file.fileno())
+
+
+def read_records(data: bytes):
+    # (user_id, raw record) for every complete record, a record still being
+    # written at the end is left for the next read
+    position = 0
+    while position + RECORD.size <= len(data):
+        user_id, length = RECORD.unpack_from(data, position)
+        end = position + RECORD.size + length
+        if end > len(data):
+            break
+        yield user_id, data[position:end]
+        position = end
+
+
+class TemplateStore:
+    def __init__(self, directory: str, make_index=None):
+        self.directory = directory
+        # Returns an empty FaceIndex with the server's settings, only
+        # append() works without it
+        self.make_index = make_index
+        self.index = make_index() if make_index else None
+        self.version = 0
+        # Bytes of the current delta log already in the index
+        self.offset = 0
+
+    def path(self, version: int, kind: str) -> str:
+        return os.path.join(self.directory, f"templates-{version:08d}.{kind}")
+
+    def latest_version(self) -> int:
+        if not os.path.isdir(self.directory):
+            return 0
+        versions = [
+            int(match.group(1))
+            for match in map(SNAPSHOT_NAME.match, os.listdir(self.directory))
+            if match
+        ]
+        return max(versions, default=0)
+
+    @contextmanager
+    def lock(self, name="lock", blocking=True):
+        # Yields False when blocking is off and another process holds it
+        if fcntl is None:
+            yield True
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, name), "a") as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def read_delta(self, version: int, offset: int = 0):
+        # ([(user_id, raw record)], offset after the last complete record)
+        try:
+            with open(self.path(version, "delta"), "rb") as delta_file:
+                delta_file.seek(offset)
+                data = delta_file.read()
+        except FileNotFoundError:
+            return [], offset
+        records = list(read_records(data))
+        return records, offset + sum(len(record) for _, record in records)
+
+    def append(self, user_id: int, blob: bytes):
+        # Record a newly enrolled user in the latest snapshot's delta log
+        record = RECORD.pack(user_id, len(blob)) + blob
+        with self.lock():
+            version = self.latest_version()
+            if not version:
+                # No snapshot yet, the first one is built from the database
+                return
+            with open(self.path(version, "delta"), "ab") as delta_file:
+                delta_file.write(record)
+
+    def _add_records(self, index, records):
+        for user_id, record in records:
+            if user_id not in index:
+                index.add(user_id, unpack_templates(record[RECORD.size :]))
+
+    def refresh(self):
+        # Switch to a newer snapshot, or replay records appended since the
+        # last refresh. Mutates the index, call it from the event loop.
+        latest = self.latest_version()
+        if latest != self.version:
+            index = self.make_index()
+            index.load(TemplateSnapshot(self.path(latest, "snap")))
+            records, offset = self.read_delta(latest)
+            self._add_records(index, records)
+            self.index, self.version, self.offset = index, latest, offset
+        else:
+            records, self.offset = self.read_delta(self.version, self.offset)
+            self._add_records(self.index, records)
+
+    def publish(self, index, newest_user_id: int, source_version: int, folded: int) -> int:
+        # Write index as snapshot source_version + 1. Records appended to the
+        # source log after the first ``folded`` bytes carry over to the new log.
+        version = source_version + 1
+        os.makedirs(self.directory, exist_ok=True)
+        snapshot_path = self.path(version, "snap")
+        write_snapshot(f"{snapshot_path}.tmp", version, newest_user_id, index)
+        with self.lock():
+            records, _ = self.read_delta(source_version, folded)
+            carried = b"".join(record for user_id, record in records if user_id not in index)
+            delta_path = self.path(version, "delta")
+            with open(f"{delta_path}.tmp", "wb") as delta_file:
+                delta_file.write(carried)
+            os.replace(f"{delta_path}.tmp", delta_path)
+            # The snapshot goes last, once it exists appends go to its log
+            os.replace(f"{snapshot_path}.tmp", snapshot_path)
+        # Keep the previous version for processes that have not refreshed yet
+        for old in range(1, source_version):
+            for kind in ("snap", "delta"):
+                try:
+                    os.remove(self.path(old, kind))
+                except FileNotFoundError:
+                    pass
+        return version
+
+    def compact(self) -> Optional[int]:
+        # Fold the latest delta log into a new snapshot. Reads and builds
+        # everything in memory, run it in a thread. None when another process
+        # is already compacting.
+        with self.lock("compact.lock", blocking=False) as acquired:
+            if not acquired:
+                return None
+            version = self.latest_version()
+            if not version:
+                return None
+            snapshot = TemplateSnapshot(self.path(version, "snap"))
+            records, folded = self.read_delta(version)
+            index = self.make_index()
+            index.build(snapshot.users())
+            self._add_records(index, records)
+            newest_user_id = max([snapshot.newest_user_id, *(user_id for user_id, _ in records)])
+            return self.publish(index, newest_user_id, version, folded)
+
+    def load(self, newest_user_id: int, all_users):
+        # Map the latest snapshot, rebuilding it from all_users (an iterable
+        # of (user_id, encodings)) when there is none or it is missing users
+        # up to newest_user_id, e.g. after an import that bypassed the log
+        with self.lock("compact.lock"):
+            version = self.latest_version()
+            if version:
+                snapshot = TemplateSnapshot(self.path(version, "snap"))
+                records, _ = self.read_delta(version)
+                known = max([snapshot.newest_user_id, *(user_id for user_id, _ in records)])
+                if known >= newest_user_id:
+                    self.refresh()
+                    return
+            index = self.make_index()
+            index.build(all_users)
+            self.publish(index, newest_user_id, version, 0)
+        self.refresh()
@@ -0,0 +1,48 @@
+"""
+Binary storage format for face templates (User.face_templates).
+
+    offset  size  field
+    0       4     magic b"FTPL"
+    4       1     format version (1)
+    5       1     dtype code (1 = float32, 2 = float16)
+    6       2     dimensions per template (128), little endian
+    8       4     number of templates, little endian
+    12      4     reserved, keeps the payload 16-byte aligned
+    16      ...   count x dimensions values, little endian, row major
+
+Five float32 templates take 2.5 KB instead of ~12 KB of JSON text, and
+unpack_templates wraps the payload with np.frombuffer without copying it.
+"""
+import struct
+
+import numpy as np
+
+
+ENCODING_SIZE = 128
+MAGIC = b"FTPL"
+VERSION = 1
+HEADER = struct.Struct("<4sBBHI4x")
+
+DTYPES = {1: np.dtype("<f4"), 2: np.dtype("<f2")}
+DTYPE_CODES = {dtype: code for code, dtype in DTYPES.items()}
+
+
+def pack_templates(encodings, dtype="float32") -> bytes:
+    dtype = np.dtype(dtype).newbyteorder("<")
+    if dtype not in DTYPE_CODES:
+        raise ValueError(f"Unsupported template dtype: {dtype}")
+    matrix = np.asarray(encodings, dtype=dtype).reshape(-1, ENCODING_SIZE)
+    header = HEADER.pack(MAGIC, VERSION, DTYPE_CODES[dtype], ENCODING_SIZE, len(matrix))
+    return header + matrix.tobytes()
+
+
+def unpack_templates(blob) -> np.ndarray:
+    # Read-only (count x dimensions) view over the blob, no copy for float32
+    if not blob:
+        return np.empty((0, ENCODING_SIZE), dtype=np.float32)
+    magic, version, dtype_code, dimensions, count = HEADER.unpack_from(blob)
+    if magic != MAGIC or version != VERSION or dtype_code not in DTYPES:
+        raise ValueError("Unrecognized face template blob.")
+    return np.frombuffer(
+        blob, dtype=DTYPES[dtype_code], count=count * dimensions, offset=HEADER.size
+    ).reshape(count, dimensions)
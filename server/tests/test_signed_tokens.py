@@ -0,0 +1,121 @@
+import json
+import time
+
+import pytest
+
+from signed_tokens import Denylist, TokenClaims, TokenSigner, b64decode, b64encode, parse_keys
+
+
+KEYS = {"k1": b"first secret", "k2": b"second secret"}
+
+
+@pytest.fixture
+def signer():
+    return TokenSigner(KEYS, "k1")
+
+
+def test_issue_and_verify(signer):
+    claims = signer.verify(signer.issue(42, 3600))
+    assert claims.user_id == 42
+    assert claims.key_id == "k1"
+    assert claims.expires_at > time.time()
+
+
+def test_tampered_claims_are_rejected(signer):
+    version, encoded_claims, signature = signer.issue(42, 3600).split(".")
+    claims = json.loads(b64decode(encoded_claims))
+    claims["uid"] = 1
+    forged = b64encode(json.dumps(claims).encode())
+    assert signer.verify(f"{version}.{forged}.{signature}") is None
+
+
+def test_tampered_signature_is_rejected(signer):
+    token = signer.issue(42, 3600)
+    payload, signature = token.rsplit(".", 1)
+    flipped = bytearray(b64decode(signature))
+    flipped[0] ^= 1
+    assert signer.verify(f"{payload}.{b64encode(bytes(flipped))}") is None
+
+
+@pytest.mark.parametrize("token", ["", "v1", "v1.e30.", "v2.e30.AAAA", "v1.!!!.AAAA"])
+def test_malformed_tokens_are_rejected(signer, token):
+    assert signer.verify(token) is None
+
+
+def test_expired_token_is_rejected(signer):
+    assert signer.verify(signer.issue(42, -1)) is None
+
+
+def test_unknown_key_id_is_rejected(signer):
+    token = TokenSigner({"k3": b"other secret"}, "k3").issue(42, 3600)
+    assert signer.verify(token) is None
+
+
+def test_same_key_id_with_another_secret_is_rejected(signer):
+    token = TokenSigner({"k1": b"wrong secret"}, "k1").issue(42, 3600)
+    assert signer.verify(token) is None
+
+
+def test_key_rotation(signer):
+    old_token = signer.issue(42, 3600)
+    rotated = TokenSigner(KEYS, "k2")
+    # Sessions signed with the previous key stay valid until it is retired
+    assert rotated.verify(old_token).key_id == "k1"
+    new_token = rotated.issue(42, 3600)
+    assert rotated.verify(new_token).key_id == "k2"
+    retired = TokenSigner({"k2": KEYS["k2"]}, "k2")
+    assert retired.verify(old_token) is None
+    assert retired.verify(new_token).user_id == 42
+
+
+def test_active_key_must_be_configured():
+    with pytest.raises(ValueError):
+        TokenSigner(KEYS, "k3")
+
+
+def test_parse_keys():
+    assert parse_keys(" k1:a, k2:b:c ,") == {"k1": b"a", "k2": b"b:c"}
+    with pytest.raises(ValueError):
+        parse_keys("k1")
+
+
+def claims(token_id, expires_in=3600):
+    return TokenClaims(1, int(time.time()) + expires_in, "k1", token_id)
+
+
+def test_denylist_sync_merges_processes(tmp_path):
+    path = str(tmp_path / "denylist.json")
+    first, second = Denylist(path), Denylist(path)
+    first.revoke(claims("a"))
+    second.revoke(claims("b"))
+    first.sync()
+    second.sync()
+    # The second sync kept the first process's entry
+    assert second.is_revoked(claims("a")) and second.is_revoked(claims("b"))
+    first.sync()
+    assert first.is_revoked(claims("b"))
+    with open(path) as denylist_file:
+        assert set(json.load(denylist_file)) == {"a", "b"}
+
+    # A restarted process picks both up
+    restarted = Denylist(path)
+    restarted.sync()
+    assert restarted.is_revoked(claims("a")) and restarted.is_revoked(claims("b"))
+
+
+def test_denylist_sync_prunes_expired_tokens(tmp_path):
+    path = str(tmp_path / "denylist.json")
+    denylist = Denylist(path)
+    denylist.revoke(claims("expired", expires_in=-1))
+    denylist.revoke(claims("live"))
+    denylist.sync()
+    assert len(denylist) == 1
+    with open(path) as denylist_file:
+        assert set(json.load(denylist_file)) == {"live"}
+
+
+def test_denylist_without_path_stays_in_memory():
+    denylist = Denylist()
+    denylist.revoke(claims("a"))
+    denylist.sync()
+    assert denylist.is_revoked(claims("a"))
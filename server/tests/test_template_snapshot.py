@@ -0,0 +1,119 @@
+import os
+
+import numpy as np
+import pytest
+
+from face_index import FaceIndex
+from template_snapshot import TemplateSnapshot, TemplateStore
+from templates import pack_templates
+
+
+def make_index():
+    # Small enough threshold that the snapshot carries IVF lists, and every
+    # list probed so searches are exact and comparable across rebuilds
+    return FaceIndex(ivf_threshold=64, nprobe=1000)
+
+
+@pytest.fixture
+def population():
+    rng = np.random.default_rng(0)
+    return {user_id: rng.normal(scale=0.09, size=(5, 128)) for user_id in range(1, 41)}
+
+
+def same_rows(templates, encodings):
+    # Snapshot rows are grouped by IVF list, a user's templates may come back
+    # in another order
+    rows = lambda matrix: sorted(map(tuple, np.asarray(matrix, dtype=np.float32)))
+    assert rows(templates) == rows(encodings)
+
+
+def search(index, probe):
+    return [(candidate.user_id, round(candidate.distance, 5)) for candidate in index.search(probe, k=5)]
+
+
+def test_load_append_refresh_compact(tmp_path, population):
+    directory = str(tmp_path)
+    store = TemplateStore(directory, make_index)
+    store.load(40, population.items())
+    assert store.version == 1
+    assert store.index.users == 40
+    assert len(TemplateSnapshot(store.path(1, "snap")).centroids) > 1
+    same_rows(store.index.templates(7), population[7])
+
+    # Another process enrolls a user through the delta log
+    rng = np.random.default_rng(1)
+    enrolled = {41: rng.normal(scale=0.09, size=(5, 128)), 42: rng.normal(scale=0.09, size=(5, 128))}
+    TemplateStore(directory).append(41, pack_templates(enrolled[41]))
+    assert 41 not in store.index
+    store.refresh()
+    assert 41 in store.index
+    assert store.index.search(enrolled[41][0], k=1)[0].user_id == 41
+
+    # A starting process finds the snapshot and its log complete, no rebuild
+    starting = TemplateStore(directory, make_index)
+    starting.load(41, [])
+    assert starting.version == 1 and 41 in starting.index
+
+    probes = [population[3][0], population[28][2], enrolled[41][1]]
+    before = [search(store.index, probe) for probe in probes]
+
+    assert store.compact() == 2
+    store.refresh()
+    assert store.version == 2
+    assert store.index.users == 41
+    assert store.index.added_users == 0
+    assert [search(store.index, probe) for probe in probes] == before
+    same_rows(store.index.templates(41), enrolled[41])
+    assert TemplateSnapshot(store.path(2, "snap")).newest_user_id == 41
+
+    # Appends now go to the new snapshot's log, the process still on
+    # version 1 switches over on its next refresh
+    TemplateStore(directory).append(42, pack_templates(enrolled[42]))
+    store.refresh()
+    starting.refresh()
+    for index in (store.index, starting.index):
+        assert index.users == 42
+        assert index.search(enrolled[42][0], k=1)[0].user_id == 42
+
+
+def test_load_rebuilds_when_users_are_missing(tmp_path, population):
+    directory = str(tmp_path)
+    TemplateStore(directory, make_index).load(40, population.items())
+    # e.g. an import that bypassed the delta log
+    population[41] = np.random.default_rng(2).normal(scale=0.09, size=(5, 128))
+    store = TemplateStore(directory, make_index)
+    store.load(41, population.items())
+    assert store.version == 2
+    assert 41 in store.index
+
+
+def test_torn_delta_record_is_left_for_the_next_refresh(tmp_path, population):
+    directory = str(tmp_path)
+    store = TemplateStore(directory, make_index)
+    store.load(40, population.items())
+    TemplateStore(directory).append(41, pack_templates(population[1]))
+    delta_path = store.path(1, "delta")
+    with open(delta_path, "rb") as delta_file:
+        record = delta_file.read()
+    # Only part of the record has been written so far
+    with open(delta_path, "wb") as delta_file:
+        delta_file.write(record[:100])
+    store.refresh()
+    assert 41 not in store.index
+    with open(delta_path, "ab") as delta_file:
+        delta_file.write(record[100:])
+    store.refresh()
+    assert 41 in store.index
+
+
+def test_rejects_unknown_snapshot(tmp_path):
+    path = tmp_path / "templates-00000001.snap"
+    path.write_bytes(b"NOPE" + bytes(60))
+    with pytest.raises(ValueError):
+        TemplateSnapshot(str(path))
+
+
+def test_append_without_snapshot_is_a_no_op(tmp_path):
+    store = TemplateStore(str(tmp_path))
+    store.append(1, pack_templates(np.zeros((1, 128))))
+    assert os.listdir(tmp_path) in ([], ["lock"])
@@ -0,0 +1,51 @@
+import numpy as np
+import pytest
+
+from templates import HEADER, MAGIC, VERSION, pack_templates, unpack_templates
+
+
+@pytest.fixture
+def encodings():
+    return np.random.default_rng(0).normal(scale=0.09, size=(5, 128))
+
+
+def test_float32_round_trip(encodings):
+    blob = pack_templates(encodings, dtype="float32")
+    assert len(blob) == HEADER.size + 5 * 128 * 4
+    templates = unpack_templates(blob)
+    assert templates.shape == (5, 128)
+    assert templates.dtype == np.float32
+    np.testing.assert_array_equal(templates, encodings.astype(np.float32))
+
+
+def test_float16_round_trip(encodings):
+    blob = pack_templates(encodings, dtype="float16")
+    assert len(blob) == HEADER.size + 5 * 128 * 2
+    templates = unpack_templates(blob)
+    assert templates.dtype == np.float16
+    np.testing.assert_allclose(templates, encodings, atol=1e-3)
+
+
+def test_single_template_and_empty_blob():
+    assert unpack_templates(pack_templates(np.zeros(128))).shape == (1, 128)
+    assert unpack_templates(b"").shape == (0, 128)
+    assert unpack_templates(None).shape == (0, 128)
+
+
+def test_unsupported_dtype():
+    with pytest.raises(ValueError):
+        pack_templates(np.zeros((1, 128)), dtype="float64")
+
+
+@pytest.mark.parametrize(
+    "header",
+    [
+        HEADER.pack(b"NOPE", VERSION, 1, 128, 1),
+        HEADER.pack(MAGIC, VERSION + 1, 1, 128, 1),
+        HEADER.pack(MAGIC, VERSION, 9, 128, 1),
+    ],
+    ids=["magic", "version", "dtype"],
+)
+def test_rejects_unknown_header(header):
+    with pytest.raises(ValueError):
+        unpack_templates(header + bytes(128 * 4))
@@ -0,0 +1,167 @@
+"""
+Reading face images from request bodies.
+
+The original contract sends images as base64 strings inside JSON, which adds
+a third to the wire size and copies the payload several times while the data
+URL prefix is stripped and the string padded. /face-auth and /face-register
+also accept:
+
+- multipart/form-data: the same field names as the JSON body, with the
+  images sent as files under ``face_encoding`` / ``face_encodings``
+- application/octet-stream or image/* (/face-auth only): the body is the
+  image, student_id and matriculation_number go in the query string
+
+Bodies are read in chunks and rejected with a 413 as soon as they pass the
+size cap, before anything is decoded. The optional
+``admit`` coroutine sees the validated form fields before any image is read
+or decoded, the rate limiter checks the student_id there.
+"""
+import base64
+import json
+
+from fastapi import HTTPException, Request, status
+from fastapi.exceptions import RequestValidationError
+from pydantic import ValidationError
+
+from config import MAX_IMAGE_BYTES
+from face_pipeline import timed
+
+
+# Room for the non-image form fields on top of the images themselves
+FIELDS_ALLOWANCE = 64 * 1024
+
+
+def safe_b64decode(image_data: str) -> bytes:
+    # Remove metadata if present
+    if image_data.startswith("data:image/jpeg;base64,"):
+        image_data = image_data.replace("data:image/jpeg;base64,", "")
+    elif image_data.startswith("data:image/png;base64,"):
+        image_data = image_data.replace("data:image/png;base64,", "")
+
+    # Ensure padding is correct
+    padding = len(image_data) % 4
+    if padding:
+        image_data += "=" * (4 - padding)
+    try:
+        return base64.b64decode(image_data)
+    except Exception as e:
+        print(f"Decoding error: {e}")
+        return None
+
+
+def too_large(limit: int) -> HTTPException:
+    return HTTPException(
+        status_code=413,
+        detail=f"Request body is larger than {limit} bytes.",
+    )
+
+
+def check_length(request: Request, limit: int):
+    length = request.headers.get("content-length")
+    if length is not None and int(length) > limit:
+        raise too_large(limit)
+
+
+async def read_stream(chunks, limit: int) -> bytes:
+    # The size check runs on every chunk, the body is copied once at the end
+    parts = []
+    size = 0
+    async for chunk in chunks:
+        size += len(chunk)
+        if size > limit:
+            raise too_large(limit)
+        parts.append(chunk)
+    return b"".join(parts)
+
+
+async def read_body(request: Request, limit: int) -> bytes:
+    check_length(request, limit)
+    return await read_stream(request.stream(), limit)
+
+
+async def read_upload_file(upload, limit: int) -> bytes:
+    async def chunks():
+        while chunk := await upload.read(64 * 1024):
+            yield chunk
+
+    return await read_stream(chunks(), limit)
+
+
+def validate(model, data: dict):
+    try:
+        return model.model_validate(data)
+    except ValidationError as e:
+        raise RequestValidationError(e.errors())
+
+
+async def read_face_upload(
+    request: Request,
+    form_model,
+    request_model,
+    image_field: str,
+    max_images: int = 1,
+    allow_raw: bool = False,
+    timings: dict = None,
+    admit=None,
+):
+    """
+    Parse a face upload in any of the supported encodings.
+
+    Returns the validated form fields (form_model) and the raw image bytes,
+    with None for any image that could not be base64 decoded. The time
+    spent base64 decoding is added to ``timings`` when given, and
+    ``admit(fields)`` is awaited before the images are touched.
+    """
+    limit = max_images * MAX_IMAGE_BYTES + FIELDS_ALLOWANCE
+    content_type = request.headers.get("content-type", "").split(";")[0].strip()
+
+    if content_type == "multipart/form-data":
+        if request.headers.get("content-length") is None:
+            raise HTTPException(
+                status_code=status.HTTP_411_LENGTH_REQUIRED,
+                detail="Content-Length is required for multipart uploads.",
+            )
+        check_length(request, limit)
+        form = await request.form(max_files=max_images, max_fields=100)
+        try:
+            fields = validate(
+                form_model,
+                {key: value for key, value in form.items() if isinstance(value, str)},
+            )
+            if admit:
+                await admit(fields)
+            images = [
+                await read_upload_file(upload, MAX_IMAGE_BYTES)
+                for upload in form.getlist(image_field)
+                if not isinstance(upload, str)
+            ]
+        finally:
+            await form.close()
+        return fields, images
+
+    if content_type == "application/octet-stream" or content_type.startswith("image/"):
+        if not allow_raw:
+            raise HTTPException(
+                status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+                detail="Send the images as multipart/form-data or JSON.",
+            )
+        fields = validate(form_model, dict(request.query_params))
+        if admit:
+            await admit(fields)
+        return fields, [await read_body(request, MAX_IMAGE_BYTES)]
+
+    # Default: the original JSON body with base64 images, capped at the
+    # base64 size of max_images images
+    body = await read_body(request, limit * 4 // 3)
+    try:
+        data = json.loads(body)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Request body is not valid JSON.")
+    parsed = validate(request_model, data if isinstance(data, dict) else {})
+    if admit:
+        await admit(parsed)
+    encoded = getattr(parsed, image_field)
+    if isinstance(encoded, str):
+        encoded = [encoded]
+    with timed({} if timings is None else timings, "base64"):
+        return parsed, [safe_b64decode(image) for image in encoded]